@@ -8,7 +8,6 @@ The variables in this module can be imported and used in other modules within th
 """
 
 import os
-from datetime import datetime
 
 from falconz import file_utilities
 
@@ -18,25 +17,30 @@ project_root = file_utilities.get_virtual_env_root()
 # Set the path to the binary folder
 BINARY_PATH = os.path.join(project_root, 'bin')
 
+# Detect the operating system and architecture once, the values are constant for the process lifetime
+SYSTEM_OS, SYSTEM_ARCH = file_utilities.get_system()
+BINARY_FOLDER = os.path.join(BINARY_PATH, f'beast-binaries-{SYSTEM_OS}-{SYSTEM_ARCH}')
+
 # Set the paths to the binaries based on the operating system
-if file_utilities.get_system()[0] == 'windows':
-    GREEDY_PATH = os.path.join(BINARY_PATH, f'beast-binaries-{file_utilities.get_system()[0]}-{file_utilities.get_system()[1]}',
-                               'greedy.exe')
-    C3D_PATH = os.path.join(BINARY_PATH, f'beast-binaries-{file_utilities.get_system()[0]}-{file_utilities.get_system()[1]}',
-                            'c3d.exe')
-    DCM2NIIX_PATH = os.path.join(BINARY_PATH,
-                                 f'beast-binaries-{file_utilities.get_system()[0]}-{file_utilities.get_system()[1]}',
-                                 'dcm2niix.exe')
-elif file_utilities.get_system()[0] in ['linux', 'mac']:
-    GREEDY_PATH = os.path.join(BINARY_PATH, f'beast-binaries-{file_utilities.get_system()[0]}-{file_utilities.get_system()[1]}',
-                               'greedy')
-    C3D_PATH = os.path.join(BINARY_PATH, f'beast-binaries-{file_utilities.get_system()[0]}-{file_utilities.get_system()[1]}',
-                            'c3d')
-    DCM2NIIX_PATH = os.path.join(BINARY_PATH, f'beast-binaries-{file_utilities.get_system()[0]}-{file_utilities.get_system()[1]}',
-                                    'dcm2niix')
+if SYSTEM_OS == 'windows':
+    BINARY_EXTENSION = '.exe'
+elif SYSTEM_OS in ['linux', 'mac']:
+    BINARY_EXTENSION = ''
 else:
     raise ValueError('Unsupported OS')
 
+# Read the binary folder once to find the binaries that are already installed
+AVAILABLE_BINARIES = {}
+if os.path.isdir(BINARY_FOLDER):
+    with os.scandir(BINARY_FOLDER) as entries:
+        AVAILABLE_BINARIES = {entry.name: entry.path for entry in entries if entry.is_file()}
+
+GREEDY_PATH = AVAILABLE_BINARIES.get(f'greedy{BINARY_EXTENSION}',
+                                     os.path.join(BINARY_FOLDER, f'greedy{BINARY_EXTENSION}'))
+C3D_PATH = AVAILABLE_BINARIES.get(f'c3d{BINARY_EXTENSION}', os.path.join(BINARY_FOLDER, f'c3d{BINARY_EXTENSION}'))
+DCM2NIIX_PATH = AVAILABLE_BINARIES.get(f'dcm2niix{BINARY_EXTENSION}',
+                                       os.path.join(BINARY_FOLDER, f'dcm2niix{BINARY_EXTENSION}'))
+
 # Define color codes for console output
 ANSI_ORANGE = '\033[38;5;208m'
 ANSI_GREEN = '\033[32m'
@@ -57,6 +61,7 @@ MINIMUM_THREADS_REQUIRED_DEFORMABLE = 8  # in number of threads
 
 # Define the shrink levels supported
 SHRINK_LEVEL = [2, 4, 8]
+START_FRAME_SHRINK_FACTOR = 4  # shrink factor used for the fast start frame selection
 
 # Define the normalized cross correlation threshold and radius
 NCC_THRESHOLD = 0.6
@@ -68,7 +73,7 @@ NO_MOCO_PREFIX = 'no_moco_'
 ALIGNED_PREFIX = 'aligned_'
 TRANSFORMS_KEYWORD = ['*warp.nii.gz', '*rigid.mat', '*affine.mat']
 MOCO_4D_FILE_NAME = 'moco_4D.nii.gz'
-FALCON_WORKING_FOLDER = 'FALCONZ-V02' + '-' + datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
+FALCON_WORKING_FOLDER_PREFIX = 'FALCONZ-V02'
 TRANSFORMS_FOLDER = 'transforms'
 MOCO_FOLDER = 'Motion-corrected-images'
 SPLIT_FOLDER = 'Split-Nifti-files'
@@ -90,3 +95,15 @@ VALID_EXTENSIONS = ['.nii', '.nii.gz', '.hdr', '.img', '.nrrd', '.mha', '.mhd']
 # ALLOWED MODES
 
 ALLOWED_MODES = ['cruise', 'dash']
+
+
+def make_working_folder_name() -> str:
+    """
+    Builds the name of the FALCONZ working folder, time-stamped at the moment of the call.
+
+    :return: The name of the working folder.
+    :rtype: str
+    """
+    from datetime import datetime
+
+    return FALCON_WORKING_FOLDER_PREFIX + '-' + datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
@@ -18,13 +18,41 @@ Usage:
     The functions in this module can be imported and used in other modules within the falconz to show predefined display messages.
 """
 
+import functools
 import logging
 import multiprocessing
-import pyfiglet
 
 from falconz import constants
 from falconz import file_utilities
 
+# Minimum memory (GB) and threads required per registration paradigm
+REGISTRATION_REQUIREMENTS = {
+    'rigid': (constants.MINIMUM_RAM_REQUIRED_RIGID, constants.MINIMUM_THREADS_REQUIRED_RIGID),
+    'affine': (constants.MINIMUM_RAM_REQUIRED_AFFINE, constants.MINIMUM_THREADS_REQUIRED_AFFINE),
+    'deformable': (constants.MINIMUM_RAM_REQUIRED_DEFORMABLE, constants.MINIMUM_THREADS_REQUIRED_DEFORMABLE),
+}
+
+# Messages that do not depend on the input, colored once at import
+ONLY_4D_MESSAGE = "Only 4D images will be considered in the analysis."
+ONLY_4D_WARNING = constants.ANSI_ORANGE + " Warning: " + ONLY_4D_MESSAGE + " " + constants.ANSI_RESET
+START_FRAME_WARNING = " " + constants.ANSI_ORANGE + "Warning: Start frame not provided. It will be calculated on the " \
+                                                    "fly. " + constants.ANSI_RESET
+SLOGAN = constants.ANSI_VIOLET + "A part of the ENHANCE community. Join us at https://enhance.pet to build the future " \
+                                 "of PET imaging together." + constants.ANSI_RESET
+
+
+@functools.lru_cache(maxsize=1)
+def render_logo() -> str:
+    """
+    Render the FALCON logo once, the figlet font is only parsed on the first call.
+
+    :return: The rendered logo.
+    :rtype: str
+    """
+    import pyfiglet
+
+    return pyfiglet.figlet_format("FALCON 2.0", font="speed").rstrip()
+
 
 def logo():
     """
@@ -33,14 +61,8 @@ def logo():
     :return: None
     """
     print(' ')
-    logo_color_code = constants.ANSI_VIOLET
-    slogan_color_code = constants.ANSI_VIOLET
-    result = logo_color_code + pyfiglet.figlet_format("FALCON 2.0", font="speed").rstrip() + "\033[0m"
-    text = slogan_color_code + "A part of the ENHANCE community. Join us at https://enhance.pet to build the future " \
-                               "of " \
-                               "PET imaging together." + "\033[0m"
-    print(result)
-    print(text)
+    print(constants.ANSI_VIOLET + render_logo() + constants.ANSI_RESET)
+    print(SLOGAN)
     print(' ')
 
 
@@ -63,11 +85,8 @@ def expectations():
 
     :return: None
     """
-    print(
-        f"{constants.ANSI_ORANGE} Warning: Only 4D images will be considered in the analysis. {constants.ANSI_RESET}")
-
-    warning_message = "Only 4D images will be considered in the analysis."
-    logging.warning(warning_message)
+    print(ONLY_4D_WARNING)
+    logging.warning(ONLY_4D_MESSAGE)
 
 
 def default_parameters(input_args):
@@ -82,7 +101,7 @@ def default_parameters(input_args):
         reference_frame_message = " Reference frame: Last frame"
     else:
         reference_frame_message = f" Reference frame: {input_args.reference_frame_index}"
-    if input_args.multi_resolution_iterations.__eq__(constants.MULTI_RESOLUTION_SCHEME):
+    if input_args.multi_resolution_iterations == constants.MULTI_RESOLUTION_SCHEME:
         multi_resolution_scheme_message = f" Multi-resolution scheme: {constants.MULTI_RESOLUTION_SCHEME}"
     else:
         multi_resolution_scheme_message = f" Multi-resolution scheme: {input_args.multi_resolution_iterations}"
@@ -99,26 +118,17 @@ def derived_parameters(input_args):
     :type input_args: argparse.Namespace
     :return: None
     """
-    if input_args.registration.__eq__('rigid'):
-        num_jobs, avail_memory, avail_threads = file_utilities.get_number_of_possible_jobs(
-            process_memory=constants.MINIMUM_RAM_REQUIRED_RIGID,
-            process_threads=constants.MINIMUM_THREADS_REQUIRED_RIGID)
-    elif input_args.registration.__eq__('affine'):
-        num_jobs, avail_memory, avail_threads = file_utilities.get_number_of_possible_jobs(
-            process_memory=constants.MINIMUM_RAM_REQUIRED_AFFINE,
-            process_threads=constants.MINIMUM_THREADS_REQUIRED_AFFINE)
-    elif input_args.registration.__eq__('deformable'):
-        num_jobs, avail_memory, avail_threads = file_utilities.get_number_of_possible_jobs(
-            process_memory=constants.MINIMUM_RAM_REQUIRED_DEFORMABLE,
-            process_threads=constants.MINIMUM_THREADS_REQUIRED_DEFORMABLE)
-    else:
+    if input_args.registration not in REGISTRATION_REQUIREMENTS:
         raise ValueError('Unsupported registration paradigm')
-
-    print(f' Available memory: {avail_memory} GB | Available threads: {avail_threads} | Number of motion correction '
-          f'done in parallel: {max(1, int(multiprocessing.cpu_count() * constants.PROPORTION_OF_CORES))}')
-    logging.info(f' Available memory: {avail_memory} GB | Available threads: {avail_threads} | Number of motion '
-                 f'correction done in parallel: {max(1, int(multiprocessing.cpu_count() * constants.PROPORTION_OF_CORES))}')
+    process_memory, process_threads = REGISTRATION_REQUIREMENTS[input_args.registration]
+    num_jobs, avail_memory, avail_threads = file_utilities.get_number_of_possible_jobs(
+        process_memory=process_memory, process_threads=process_threads)
+
+    resources_message = f' Available memory: {avail_memory} GB | Available threads: {avail_threads} | Number of ' \
+                        f'motion correction done in parallel: ' \
+                        f'{max(1, int(multiprocessing.cpu_count() * constants.PROPORTION_OF_CORES))}'
+    print(resources_message)
+    logging.info(resources_message)
     # if input arguments doesn't have start frame, display message saying it will be calculated on the fly
     if input_args.start_frame == 99:
-        print(f' {constants.ANSI_ORANGE}Warning: Start frame not provided. It will be calculated on the fly. '
-              f'{constants.ANSI_RESET}')
+        print(START_FRAME_WARNING)
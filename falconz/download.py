@@ -20,16 +20,340 @@ The functions in this module can be imported and used in other modules within th
 binaries and models for the falconz.
 """
 
+import hashlib
 import logging
 import os
+import shutil
+import struct
+import sys
+import tarfile
+import threading
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from rich.console import Console
-from rich.progress import Progress, BarColumn, TextColumn, TimeRemainingColumn, FileSizeColumn, TransferSpeedColumn
 
 from falconz import constants
 
+ZSTD_TAR_EXTENSION = '.tar.zst'
+DOWNLOAD_CONNECTIONS = 8
+CHUNK_SIZE = 1024 * 1024
+# Layout of a zip local file header, the member data starts right after the header, file name and extra field
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+ZIP_ENCRYPTED_FLAG = 0x1
+
+
+def get_member_path(member, destination):
+    """
+    Gets the path a zip member is extracted to, without empty, current or parent directory components.
+
+    :param member: The archive member.
+    :type member: zipfile.ZipInfo
+    :param destination: The directory the archive is extracted to.
+    :type destination: str
+    :return: The path of the extracted member.
+    :rtype: str
+    """
+    return os.path.join(destination, *[part for part in member.filename.split('/')
+                                       if part not in ('', os.path.curdir, os.path.pardir)])
+
+
+def extract_member(zip_ref, member, destination):
+    """
+    Extracts a single member of a zip archive. The parent directories of the member must already exist.
+
+    :param zip_ref: The opened zip archive.
+    :type zip_ref: zipfile.ZipFile
+    :param member: The archive member to extract.
+    :type member: zipfile.ZipInfo
+    :param destination: The directory to extract the member to.
+    :type destination: str
+    :return: The uncompressed size of the extracted member.
+    :rtype: int
+    """
+    if can_sendfile_member(member):
+        sendfile_member(zip_ref.filename, member, get_member_path(member, destination))
+        return member.file_size
+
+    zip_ref.extract(member, destination)
+    return member.file_size
+
+
+def extract_members(filename, members, destination, update_progress):
+    """
+    Extracts the members of a zip archive concurrently, each worker thread reading through its own archive handle.
+
+    :param filename: The path to the zip archive.
+    :type filename: str
+    :param members: The archive members to extract.
+    :type members: list
+    :param destination: The directory to extract the members to.
+    :type destination: str
+    :param update_progress: Callback receiving the uncompressed size of every extracted member.
+    :type update_progress: callable
+    """
+    # Create all directories up front, so that concurrent extractions never race to create the same parent
+    for member in members:
+        member_path = get_member_path(member, destination)
+        os.makedirs(member_path if member.is_dir() else os.path.dirname(member_path), exist_ok=True)
+
+    # A ZipFile shares one file position between its readers, so it must not be used by several threads at once
+    thread_archives = threading.local()
+    opened_archives = []
+    lock = threading.Lock()
+
+    def extract(member):
+        if not hasattr(thread_archives, 'zip_ref'):
+            thread_archives.zip_ref = zipfile.ZipFile(filename, 'r')
+            with lock:
+                opened_archives.append(thread_archives.zip_ref)
+        return extract_member(thread_archives.zip_ref, member, destination)
+
+    try:
+        # Members are inflated concurrently, zlib releases the GIL during decompression
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for extracted_size in executor.map(extract, members):
+                update_progress(extracted_size)
+    finally:
+        for zip_ref in opened_archives:
+            zip_ref.close()
+
+
+def can_sendfile_member(member):
+    """
+    Checks if a zip member can be copied to disk by the kernel without passing through Python.
+
+    Only Linux supports sendfile between regular files, and only unencrypted members stored without compression
+    hold their content verbatim inside the archive.
+
+    :param member: The archive member.
+    :type member: zipfile.ZipInfo
+    :return: True if the member can be extracted with sendfile, False otherwise.
+    :rtype: bool
+    """
+    return (sys.platform.startswith('linux') and member.compress_type == zipfile.ZIP_STORED
+            and not member.is_dir() and not member.flag_bits & ZIP_ENCRYPTED_FLAG)
+
+
+def sendfile_member(archive_path, member, target_path):
+    """
+    Extracts a stored (uncompressed) zip member with os.sendfile, copying the data inside the kernel. The written file
+    is read back to check its CRC-32, as zipfile does for the members it extracts.
+
+    :param archive_path: The path to the zip archive.
+    :type archive_path: str
+    :param member: The stored archive member.
+    :type member: zipfile.ZipInfo
+    :param target_path: The path of the extracted file.
+    :type target_path: str
+    """
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    with open(archive_path, 'rb') as archive, open(target_path, 'wb') as target:
+        archive.seek(member.header_offset)
+        local_header = ZIP_LOCAL_HEADER.unpack(archive.read(ZIP_LOCAL_HEADER.size))
+        file_name_length, extra_field_length = local_header[10], local_header[11]
+        offset = member.header_offset + ZIP_LOCAL_HEADER.size + file_name_length + extra_field_length
+        remaining = member.file_size
+        while remaining > 0:
+            sent = os.sendfile(target.fileno(), archive.fileno(), offset, remaining)
+            if sent == 0:
+                raise zipfile.BadZipFile(f"Unexpected end of data for {member.filename}")
+            offset += sent
+            remaining -= sent
+
+    crc = 0
+    with open(target_path, 'rb') as target:
+        for block in iter(lambda: target.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(block, crc)
+    if crc != member.CRC:
+        os.remove(target_path)
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file {member.filename}")
+
+
+def extract_tar_member(tar, member, destination):
+    """
+    Extracts a single tarball member, refusing members that would be written or link outside of the destination.
+
+    Python versions with extraction filters use the 'data' filter, which also drops special files and unsafe
+    permission bits. Older versions apply the same path checks as get_member_path does for zip archives.
+
+    :param tar: The opened tarball.
+    :type tar: tarfile.TarFile
+    :param member: The tarball member to extract.
+    :type member: tarfile.TarInfo
+    :param destination: The directory to extract the member to.
+    :type destination: str
+    :raises: tarfile.TarError if the member points outside of the destination.
+    """
+    if hasattr(tarfile, 'data_filter'):
+        tar.extract(member, destination, filter='data')
+        return
+
+    for path in (member.name, member.linkname if member.issym() or member.islnk() else ''):
+        if os.path.isabs(path) or os.path.pardir in path.replace('\\', '/').split('/'):
+            raise tarfile.TarError(f"Refusing to extract {member.name} outside of {destination}")
+    tar.extract(member, destination)
+
+
+def extract_zstd_tarball(compressed_stream, destination, update_progress=None):
+    """
+    Extracts a zstandard compressed tarball in a single streaming pass.
+
+    :param compressed_stream: A readable binary stream of the compressed tarball, e.g. an open file or a raw HTTP response.
+    :type compressed_stream: io.RawIOBase
+    :param destination: The directory to extract the tarball to.
+    :type destination: str
+    :param update_progress: Optional callback receiving the number of compressed bytes consumed so far.
+    :type update_progress: callable
+    """
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("The zstandard package is needed to extract .tar.zst archives, install it with "
+                          "'pip install zstandard'.") from e
+
+    decompressor = zstandard.ZstdDecompressor()
+    with decompressor.stream_reader(compressed_stream, closefd=False) as reader:
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            for member in tar:
+                extract_tar_member(tar, member, destination)
+                if update_progress is not None:
+                    update_progress(compressed_stream.tell())
+
+
+class HashingReader:
+    """
+    Wraps a readable binary stream and calculates the SHA-256 digest of everything read through it.
+
+    :param stream: The stream to read from.
+    :type stream: io.RawIOBase
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.sha256.update(data)
+        return data
+
+    def tell(self):
+        return self.stream.tell()
+
+    def hexdigest(self):
+        """
+        Reads the rest of the stream and returns the SHA-256 digest of all of its bytes.
+
+        :return: The hexadecimal SHA-256 digest.
+        :rtype: str
+        """
+        for _ in iter(lambda: self.read(CHUNK_SIZE), b""):
+            pass
+        return self.sha256.hexdigest()
+
+
+def calculate_sha256(filename, block_size=1024 * 1024):
+    """
+    Calculates the SHA-256 digest of a file by reading it in blocks.
+
+    :param filename: The path to the file.
+    :type filename: str
+    :param block_size: The number of bytes read per block.
+    :type block_size: int
+    :return: The hexadecimal SHA-256 digest.
+    :rtype: str
+    """
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def create_session(connections=DOWNLOAD_CONNECTIONS):
+    """
+    Creates an HTTP session that keeps its connections alive across requests.
+
+    :param connections: The number of connections kept in the pool.
+    :type connections: int
+    :return: The HTTP session.
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # The archives are already compressed, a transfer encoding would only add decompression work
+    session.headers["Accept-Encoding"] = "identity"
+    return session
+
+
+def download_range(session, url, filename, start, end, update_progress):
+    """
+    Downloads a byte range of a remote file into the matching offset of a pre-allocated local file.
+
+    :param session: The HTTP session to issue the request with.
+    :type session: requests.Session
+    :param url: The url of the remote file.
+    :type url: str
+    :param filename: The path to the pre-allocated local file.
+    :type filename: str
+    :param start: The first byte of the range.
+    :type start: int
+    :param end: The last byte of the range (inclusive).
+    :type end: int
+    :param update_progress: Callback receiving the number of bytes written per chunk.
+    :type update_progress: callable
+    :return: True if the server sent the complete range, False otherwise.
+    :rtype: bool
+    """
+    written_bytes = 0
+    with session.get(url, headers={"Range": f"bytes={start}-{end}"}, stream=True) as response:
+        if response.status_code != 206:
+            return False
+        response.raw.decode_content = False
+        with open(filename, "r+b") as file:
+            file.seek(start)
+            for chunk in iter(lambda: response.raw.read(CHUNK_SIZE), b""):
+                file.write(chunk)
+                written_bytes += len(chunk)
+                update_progress(len(chunk))
+    # A connection closed early leaves a hole in the file
+    return written_bytes == end - start + 1
+
+
+def download_in_ranges(session, url, filename, total_size, update_progress, connections=DOWNLOAD_CONNECTIONS):
+    """
+    Downloads a remote file over several parallel HTTP range requests.
+
+    :param session: The HTTP session to issue the requests with.
+    :type session: requests.Session
+    :param url: The url of the remote file.
+    :type url: str
+    :param filename: The path to store the file.
+    :type filename: str
+    :param total_size: The size of the remote file in bytes.
+    :type total_size: int
+    :param update_progress: Callback receiving the number of bytes written per chunk.
+    :type update_progress: callable
+    :param connections: The number of parallel connections.
+    :type connections: int
+    :return: True if all ranges were downloaded, False if the server does not support range requests or a range is
+        incomplete.
+    :rtype: bool
+    """
+    with open(filename, "wb") as file:
+        file.truncate(total_size)
+
+    range_size = -(-total_size // connections)
+    ranges = [(start, min(start + range_size, total_size) - 1) for start in range(0, total_size, range_size)]
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        results = list(executor.map(
+            lambda byte_range: download_range(session, url, filename, *byte_range, update_progress), ranges))
+    return all(results)
+
 
 def download(item_name, item_path, item_dict):
     """
@@ -44,6 +368,11 @@ def download(item_name, item_path, item_dict):
     :return: The path to the downloaded item.
     :rtype: str
     """
+    # rich is only needed when something is downloaded
+    from rich.console import Console
+    from rich.progress import Progress, BarColumn, TextColumn, TimeRemainingColumn, FileSizeColumn, \
+        TransferSpeedColumn
+
     item_info = item_dict[item_name]
     url = item_info["url"]
     filename = os.path.join(item_path, item_info["filename"])
@@ -53,58 +382,91 @@ def download(item_name, item_path, item_dict):
         logging.info(f" Downloading {directory}")
 
         # show progress using rich
-        response = requests.get(url, stream=True)
-        total_size = int(response.headers.get("Content-Length", 0))
-        chunk_size = 1024 * 10
-
-        console = Console()
-        progress = Progress(
-            TextColumn("[bold blue]{task.description}"),
-            BarColumn(bar_width=None),
-            "[progress.percentage]{task.percentage:>3.0f}%",
-            "•",
-            FileSizeColumn(),
-            TransferSpeedColumn(),
-            TimeRemainingColumn(),
-            console=console,
-            expand=True
-        )
-
-        with progress:
-            task = progress.add_task(f"[white] Downloading system specific binaries: {item_name}", total=total_size)
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                open(filename, "ab").write(chunk)
-                progress.update(task, advance=chunk_size)
-
-        # Unzip the item
-        progress = Progress(  # Create new instance for extraction task
-            TextColumn("[bold blue]{task.description}"),
-            BarColumn(bar_width=None),
-            "[progress.percentage]{task.percentage:>3.0f}%",
-            "•",
-            FileSizeColumn(),
-            TransferSpeedColumn(),
-            TimeRemainingColumn(),
-            console=console,
-            expand=True
-        )
-
-        with progress:
-            with zipfile.ZipFile(filename, 'r') as zip_ref:
-                total_size = sum((file.file_size for file in zip_ref.infolist()))
-                task = progress.add_task(f"[white] Extracting system specific binaries: {item_name}",
-                                         total=total_size)
-                # Get the parent directory of 'directory'
-                parent_directory = os.path.dirname(directory)
-                for file in zip_ref.infolist():
-                    zip_ref.extract(file, parent_directory)
-                    extracted_size = file.file_size
-                    progress.update(task, advance=extracted_size)
+        # The session is closed even if the download, the checksum or the extraction fails
+        with create_session() as session:
+            # Only the headers are needed to choose how to download, the body is requested once the choice is made
+            head_response = session.head(url, allow_redirects=True)
+            total_size = int(head_response.headers.get("Content-Length", 0))
+            accepts_ranges = head_response.headers.get("Accept-Ranges") == "bytes"
 
-        logging.info(f" {os.path.basename(directory)} extracted.")
+            console = Console()
+            progress = Progress(
+                TextColumn("[bold blue]{task.description}"),
+                BarColumn(bar_width=None),
+                "[progress.percentage]{task.percentage:>3.0f}%",
+                "•",
+                FileSizeColumn(),
+                TransferSpeedColumn(),
+                TimeRemainingColumn(),
+                console=console,
+                expand=True
+            )
+
+            # Get the parent directory of 'directory'
+            parent_directory = os.path.dirname(directory)
+
+            if filename.endswith(ZSTD_TAR_EXTENSION):
+                # Tarballs are read sequentially, so the response body is extracted while it is being downloaded
+                with progress:
+                    task = progress.add_task(
+                        f"[white] Downloading and extracting system specific binaries: {item_name}", total=total_size)
+                    with session.get(url, stream=True) as response:
+                        response.raw.decode_content = True
+                        compressed_stream = HashingReader(response.raw)
+                        extract_zstd_tarball(compressed_stream, parent_directory,
+                                             lambda consumed_bytes: progress.update(task, completed=consumed_bytes))
+                        # The archive is never stored, so its checksum is calculated over the streamed bytes
+                        expected_sha256 = item_info.get("sha256")
+                        if expected_sha256 is not None and compressed_stream.hexdigest() != expected_sha256.lower():
+                            shutil.rmtree(directory, ignore_errors=True)
+                            logging.error(f" Checksum mismatch for {item_info['filename']}.")
+                            raise ValueError(f"Checksum mismatch for {item_info['filename']}, the download may be "
+                                             f"corrupted.")
+            else:
+                # A single progress display covers both the download and the extraction
+                with progress:
+                    download_task = progress.add_task(f"[white] Downloading system specific binaries: {item_name}",
+                                                      total=total_size)
+                    downloaded = False
+                    if accepts_ranges and total_size > 0:
+                        downloaded = download_in_ranges(
+                            session, url, filename, total_size,
+                            lambda chunk_length: progress.update(download_task, advance=chunk_length))
+                        if not downloaded:
+                            # The server ignored or cut short the range requests, fall back to a single stream
+                            progress.reset(download_task)
 
-        # Delete the zip file
-        os.remove(filename)
+                    if not downloaded:
+                        with session.get(url, stream=True) as response:
+                            # Read the raw socket stream, the archive is stored as is and needs no content decoding
+                            response.raw.decode_content = False
+                            with open(filename, "wb") as file:
+                                for chunk in iter(lambda: response.raw.read(CHUNK_SIZE), b""):
+                                    file.write(chunk)
+                                    progress.update(download_task, advance=len(chunk))
+
+                    # Verify the archive before extracting it, if a checksum is available for the item
+                    expected_sha256 = item_info.get("sha256")
+                    if expected_sha256 is not None and calculate_sha256(filename) != expected_sha256.lower():
+                        os.remove(filename)
+                        logging.error(f" Checksum mismatch for {item_info['filename']}.")
+                        raise ValueError(f"Checksum mismatch for {item_info['filename']}, the download may be "
+                                         f"corrupted.")
+
+                    # Unzip the item, the central directory of a zip archive is only readable from the complete file.
+                    # No separate testzip() pass, the CRC of every member is already checked while it is extracted
+                    with zipfile.ZipFile(filename, 'r') as zip_ref:
+                        members = zip_ref.infolist()
+                    total_size = sum(member.file_size for member in members)
+                    extraction_task = progress.add_task(f"[white] Extracting system specific binaries: {item_name}",
+                                                        total=total_size)
+                    extract_members(filename, members, parent_directory,
+                                    lambda extracted_size: progress.update(extraction_task, advance=extracted_size))
+
+                # Delete the zip file
+                os.remove(filename)
+
+        logging.info(f" {os.path.basename(directory)} extracted.")
         print(f"{constants.ANSI_GREEN} Binaries - download complete. {constants.ANSI_RESET}")
         logging.info(f" Binaries - download complete.")
     else:
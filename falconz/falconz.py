@@ -16,18 +16,13 @@ import argparse
 import logging
 import multiprocessing
 import os
-import shutil
 import sys
 from datetime import datetime
 
 import colorama
 import emoji
-from falconz.constants import FALCON_WORKING_FOLDER, PROPORTION_OF_CORES
-from falconz.image_conversion import NiftiConverter, NiftiConverterError, merge3d
-from falconz.image_processing import determine_candidate_frames, align
+from falconz.constants import PROPORTION_OF_CORES
 from falconz.input_validation import InputValidation
-from rich.console import Console
-from rich.progress import Progress, TextColumn, TimeElapsedColumn
 
 from falconz import constants
 from falconz import display
@@ -35,9 +30,19 @@ from falconz import download
 from falconz import file_utilities
 from falconz import resources
 
-logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s', level=logging.INFO,
-                    filename=datetime.now().strftime('falconz-v.1.0.0.%H-%M-%d-%m-%Y.log'),
-                    filemode='w')
+
+def configure_logging(log_dir: str = None):
+    """
+    Configures the FalconZ log file. The file is only created once the first record is logged.
+
+    :param log_dir: The directory to write the log file to. Defaults to the current working directory.
+    :type log_dir: str
+    """
+    log_file = datetime.now().strftime('falconz-v.1.0.0.%H-%M-%d-%m-%Y.log')
+    if log_dir is not None:
+        log_file = os.path.join(log_dir, log_file)
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s', level=logging.INFO,
+                        handlers=[logging.FileHandler(log_file, mode='w', delay=True)])
 
 
 def main():
@@ -57,6 +62,7 @@ def main():
 
     :returns: None. But as a side-effect, produces motion-corrected images and other outputs.
     """
+    configure_logging()
     colorama.init()
 
     # Initialization: Setting up arguments, parsers, etc.
@@ -83,6 +89,12 @@ def main():
         default=99,
         help="frame from which the motion correction will be performed"
     )
+    parser.add_argument(
+        "-fsf",
+        "--fast_start_frame",
+        action="store_true",
+        help="determine the start frame on downscaled images (faster, only used if no start frame is provided)"
+    )
     parser.add_argument(
         "-r",
         "--registration",
@@ -106,16 +118,30 @@ def main():
         choices=constants.ALLOWED_MODES,
         help="Mode of operation: cruise | dash"
     )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Skip the banner, citation and parameter summary (e.g. for batch processing)"
+    )
     args = parser.parse_args()
+
     validator = InputValidation(args)
     validator.validate()
+
+    # The imaging stack is heavy to import, load it only after the arguments are validated (e.g. not for --help)
+    from falconz.image_conversion import NiftiConverter, NiftiConverterError, merge3d
+    from falconz.image_processing import determine_candidate_frames, align
+    from rich.console import Console
+    from rich.progress import Progress, TextColumn, TimeElapsedColumn
+
     # change the multi-resolution scheme if the mode of operation is dash
     if args.mode == 'dash':
         args.multi_resolution_iterations = constants.MULTI_RESOLUTION_SCHEME_DASH
 
-
-    display.logo()
-    display.citation()
+    if not args.quiet:
+        display.logo()
+        display.citation()
 
     logging.info('----------------------------------------------------------------------------------------------------')
     logging.info('                                     STARTING FALCON-Z V.2.0.0                                      ')
@@ -125,12 +151,13 @@ def main():
     # INPUT VALIDATION AND PREPARATION
     # ----------------------------------
 
-    print(' ')
-    print(f'{constants.ANSI_VIOLET} {emoji.emojize(":memo:")} NOTE:{constants.ANSI_RESET}')
-    print(' ')
-    display.expectations()
-    display.default_parameters(args)
-    display.derived_parameters(args)
+    if not args.quiet:
+        print(' ')
+        print(f'{constants.ANSI_VIOLET} {emoji.emojize(":memo:")} NOTE:{constants.ANSI_RESET}')
+        print(' ')
+        display.expectations()
+        display.default_parameters(args)
+        display.derived_parameters(args)
 
     # ----------------------------------
     # DOWNLOADING THE BINARIES
@@ -147,9 +174,12 @@ def main():
           f'{constants.ANSI_RESET}')
     download.download(item_name=f'falcon-{system_os}-{system_arch}', item_path=binary_path,
                       item_dict=resources.FALCON_BINARIES)
-    file_utilities.set_permissions(constants.GREEDY_PATH, system_os)
-    file_utilities.set_permissions(constants.C3D_PATH, system_os)
-    file_utilities.set_permissions(constants.DCM2NIIX_PATH, system_os)
+    # Freshly extracted binaries carry no execute bits, so on Linux and Mac the check only skips the chmod for
+    # binaries installed by an earlier run. os.access always reports Windows files as executable, so the access is
+    # always granted there.
+    for binary in (constants.GREEDY_PATH, constants.C3D_PATH, constants.DCM2NIIX_PATH):
+        if system_os not in ('linux', 'mac') or not os.access(binary, os.X_OK):
+            file_utilities.set_permissions(binary, system_os)
 
     # ----------------------------------
     # INPUT STANDARDIZATION
@@ -164,7 +194,7 @@ def main():
     logging.info(' ')
     image_dir = os.path.normpath(args.directory)
     parent_dir = os.path.dirname(image_dir)
-    falcon_dir = os.path.join(parent_dir, FALCON_WORKING_FOLDER)
+    falcon_dir = os.path.join(parent_dir, constants.make_working_folder_name())
     file_utilities.create_directory(falcon_dir)
     split_nifti_dir = os.path.join(falcon_dir, constants.SPLIT_FOLDER)
     file_utilities.create_directory(split_nifti_dir)
@@ -199,9 +229,10 @@ def main():
     # MOTION CORRECTION
     # ----------------------------------
 
-    org_nifti_files = file_utilities.get_files(split_nifti_dir, '*.nii')
+    split_nifti_files = file_utilities.get_files_by_wildcards(split_nifti_dir, ['*.nii', '*.nii.gz'])
+    org_nifti_files = split_nifti_files['*.nii']
     if len(org_nifti_files) == 0:
-        org_nifti_files = file_utilities.get_files(split_nifti_dir, '*.nii.gz')
+        org_nifti_files = split_nifti_files['*.nii.gz']
     reference_file = org_nifti_files[args.reference_frame_index]
     candidate_frames = org_nifti_files.copy()
     candidate_frames.remove(reference_file)
@@ -211,7 +242,9 @@ def main():
         n_jobs = multiprocessing.cpu_count()
         # Calculate the number of cores to use, ensuring it's at least 1
         actual_n_jobs = max(1, round(n_jobs * PROPORTION_OF_CORES))
-        start_frame_file = determine_candidate_frames(candidate_frames, reference_file, falcon_dir, actual_n_jobs)
+        shrink_factor = constants.START_FRAME_SHRINK_FACTOR if args.fast_start_frame else None
+        start_frame_file = determine_candidate_frames(candidate_frames, reference_file, falcon_dir, actual_n_jobs,
+                                                      shrink_factor=shrink_factor)
         # find the index of the start_frame_file in the org_nifti_files list
         start_frame = org_nifti_files.index(start_frame_file)
     # everything from and after start_frame will be motion corrected and will be called moving frames
@@ -239,24 +272,22 @@ def main():
     # CLEAN TRANSFORMS
     transforms_dir = os.path.join(falcon_dir, constants.TRANSFORMS_FOLDER)
     file_utilities.create_directory(transforms_dir)
+    transform_files = file_utilities.get_files_by_wildcards(split_nifti_dir, constants.TRANSFORMS_KEYWORD)
+    # Both folders live in the FALCON working folder, so the transforms can be renamed in place
     for transform_keyword in constants.TRANSFORMS_KEYWORD:
-        transform_files = file_utilities.get_files(split_nifti_dir, transform_keyword)
-        if len(transform_files) > 0:
-            for transform_file in transform_files:
-                shutil.move(transform_file, transforms_dir)
-        else:
-            continue
-
-    # COPY THE REFERENCE FRAME FROM THE SPLIT NIFTI FOLDER TO THE MOCO FOLDER WITH MOCO PREFIX
+        for transform_file in transform_files[transform_keyword]:
+            os.replace(transform_file, os.path.join(transforms_dir, os.path.basename(transform_file)))
+
+    # LINK (OR COPY) THE REFERENCE FRAME FROM THE SPLIT NIFTI FOLDER TO THE MOCO FOLDER WITH MOCO PREFIX
     reference_file_name = os.path.basename(reference_file)
     moco_reference_file = os.path.join(moco_dir, constants.NO_MOCO_PREFIX + reference_file_name)
-    shutil.copy(reference_file, moco_reference_file)
+    file_utilities.link_or_copy_file(reference_file, moco_reference_file)
 
-    # COPY THE NON-MOCO FRAMES FROM THE SPLIT NIFTI FOLDER TO THE MOCO FOLDER WITH MOCO PREFIX
+    # LINK (OR COPY) THE NON-MOCO FRAMES FROM THE SPLIT NIFTI FOLDER TO THE MOCO FOLDER WITH MOCO PREFIX
     for non_moco_frame in non_moco_frames:
         non_moco_frame_name = os.path.basename(non_moco_frame)
         moco_non_moco_frame = os.path.join(moco_dir, constants.NO_MOCO_PREFIX + non_moco_frame_name)
-        shutil.copy(non_moco_frame, moco_non_moco_frame)
+        file_utilities.link_or_copy_file(non_moco_frame, moco_non_moco_frame)
 
     # MERGE THE 3D MOCO FRAMES TO A 4D NIFTI FILE
     merge3d(moco_dir, '*' + constants.MOCO_PREFIX + '*', os.path.join(moco_dir, constants.MOCO_4D_FILE_NAME))
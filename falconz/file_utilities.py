@@ -14,7 +14,9 @@ Usage:
     The functions in this module can be imported and used in other modules within the falconz to perform file operations.
 """
 
-import glob
+import atexit
+import fnmatch
+import functools
 import os
 import platform
 import shutil
@@ -22,11 +24,14 @@ import stat
 import subprocess
 import sys
 import re
-from multiprocessing import Pool
+import time
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 import psutil
 
+NUMBER_PATTERN = re.compile(r'(\d+)')
+
 
 def set_permissions(file_path, system_type):
     """
@@ -40,10 +45,11 @@ def set_permissions(file_path, system_type):
     :rtype: None
     :raises: ValueError if the operating system is not supported.
 
-    This function sets permissions for a file based on the operating system. If the operating system is Windows, it uses
-    the `icacls` command to grant full access to everyone. If the operating system is Linux or Mac, it uses the `chmod`
-    command to add execute permission for the owner, read permission for the group, and read permission for others. If
-    the operating system is not supported, it raises a ValueError.
+    This function sets permissions for a file based on the operating system. If the operating system is Windows, it
+    grants full access to everyone through the Windows security API, falling back to the `icacls` command. If the
+    operating system is Linux or Mac, it uses the `chmod` command to add execute permission for the owner, read
+    permission for the group, and read permission for others. If the operating system is not supported, it raises a
+    ValueError.
 
     :raises: ValueError if the operating system is not supported.
     :raises: subprocess.CalledProcessError if the `icacls` command fails on Windows.
@@ -55,7 +61,8 @@ def set_permissions(file_path, system_type):
     """
     try:
         if system_type == "windows":
-            subprocess.check_call(["icacls", file_path, "/grant", "Everyone:(F)"])
+            if not grant_full_access_windows(file_path):
+                subprocess.check_call(["icacls", file_path, "/grant", "Everyone:(F)"])
         elif system_type in ["linux", "mac"]:
             os.chmod(file_path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IROTH)
         else:
@@ -72,6 +79,45 @@ def set_permissions(file_path, system_type):
         exit(1)
 
 
+# Access control list granting full access to everyone, in the security descriptor string format of Windows
+EVERYONE_FULL_ACCESS_SDDL = "D:(A;;FA;;;WD)"
+_everyone_full_access = None
+
+
+def grant_full_access_windows(file_path: str) -> bool:
+    """
+    Grants everyone full access to a file through the Windows security API, without spawning an icacls process.
+
+    :param file_path: The path to the file.
+    :type file_path: str
+    :return: True if the access was granted, False if the security API is not available or the call failed.
+    :rtype: bool
+    """
+    global _everyone_full_access
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        advapi32 = ctypes.WinDLL('advapi32', use_last_error=True)
+        if _everyone_full_access is None:
+            # The security descriptor is built once and kept for the lifetime of the process
+            descriptor = ctypes.c_void_p()
+            if not advapi32.ConvertStringSecurityDescriptorToSecurityDescriptorW(
+                    EVERYONE_FULL_ACCESS_SDDL, 1, ctypes.byref(descriptor), None):  # 1: SDDL_REVISION_1
+                return False
+            dacl_present, dacl_defaulted, dacl = wintypes.BOOL(), wintypes.BOOL(), ctypes.c_void_p()
+            if not advapi32.GetSecurityDescriptorDacl(descriptor, ctypes.byref(dacl_present), ctypes.byref(dacl),
+                                                      ctypes.byref(dacl_defaulted)):
+                return False
+            _everyone_full_access = (descriptor, dacl)
+
+        # 1: SE_FILE_OBJECT, 4: DACL_SECURITY_INFORMATION, the call returns ERROR_SUCCESS (0) on success
+        return advapi32.SetNamedSecurityInfoW(ctypes.c_wchar_p(file_path), 1, 4, None, None,
+                                              _everyone_full_access[1], None) == 0
+    except (AttributeError, ImportError, OSError):
+        return False
+
+
 def numeric_sort_key(file_path: str) -> int:
     """
     Extracts the numeric portion from a filename for sorting purposes.
@@ -82,12 +128,13 @@ def numeric_sort_key(file_path: str) -> int:
     :rtype: int
     """
     # Extract the number from the filename using regex
-    match = re.search(r'(\d+)', os.path.basename(file_path))
+    match = NUMBER_PATTERN.search(os.path.basename(file_path))
     if match:
         return int(match.group(1))
     return 0
 
 
+@functools.lru_cache(maxsize=1)
 def get_virtual_env_root():
     """
     Gets the root directory of the virtual environment.
@@ -100,6 +147,7 @@ def get_virtual_env_root():
     return virtual_env_root
 
 
+@functools.lru_cache(maxsize=1)
 def get_system():
     """
     Gets the system and architecture information.
@@ -139,8 +187,7 @@ def create_directory(directory_path: str):
     :param directory_path: The path to the directory.
     :type directory_path: str
     """
-    if not os.path.isdir(directory_path):
-        os.makedirs(directory_path)
+    os.makedirs(directory_path, exist_ok=True)
 
 
 def get_files(directory_path: str, wildcard: str):
@@ -154,32 +201,149 @@ def get_files(directory_path: str, wildcard: str):
     :return: The list of files.
     :rtype: list
     """
-    return sorted(glob.glob(os.path.join(directory_path, wildcard)))
+    return get_files_by_wildcards(directory_path, [wildcard])[wildcard]
+
+
+def get_files_by_wildcards(directory_path: str, wildcards: list) -> dict:
+    """
+    Gets the files matching each of the wildcards from the specified directory, reading the directory only once.
+
+    :param directory_path: The path to the directory.
+    :type directory_path: str
+    :param wildcards: The wildcards to be used.
+    :type wildcards: list
+    :return: A dictionary mapping each wildcard to the sorted list of matching files.
+    :rtype: dict
+    """
+    files_by_wildcard = {wildcard: [] for wildcard in wildcards}
+    # Compile each wildcard once, case-insensitive where the file system is (os.path.normcase), as glob does
+    patterns = [(re.compile(fnmatch.translate(os.path.normcase(wildcard))), files_by_wildcard[wildcard])
+                for wildcard in wildcards]
+    if not os.path.isdir(directory_path):
+        return files_by_wildcard
+    for name, path in scan_directory(directory_path):
+        # Hidden files are skipped, as glob does
+        if name.startswith('.'):
+            continue
+        name = os.path.normcase(name)
+        for pattern, files in patterns:
+            if pattern.match(name):
+                files.append(path)
+    # Sort in place, sorted() would build a second copy of each list
+    for files in files_by_wildcard.values():
+        files.sort()
+    return files_by_wildcard
 
 
 def copy_file(file, destination):
     """
     Copies a file to the destination directory.
 
+    Only the file content is copied, using shutil.copyfile which hands the copy to the kernel (sendfile on Linux,
+    fcopyfile on macOS, CopyFileW on Windows). The permission bits are not copied, as they are not needed downstream.
+
     :param file: The path to the file.
     :type file: str
     :param destination: The path to the destination directory.
     :type destination: str
     """
-    shutil.copy(file, destination)
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(file))
+    shutil.copyfile(file, destination)
+    invalidate_directory_cache(destination)
 
 
-def copy_files_to_destination(files: list, destination: str):
+def link_or_copy_file(file, destination_file):
+    """
+    Makes a file available under a new path by hard linking it, falling back to a copy if linking is not possible
+    (e.g. across file systems). Only use this for files that are not modified afterwards, as both paths share the data.
+
+    :param file: The path to the file.
+    :type file: str
+    :param destination_file: The path of the new file.
+    :type destination_file: str
+    """
+    try:
+        os.link(file, destination_file)
+    except OSError:
+        shutil.copy(file, destination_file)
+    invalidate_directory_cache(destination_file)
+
+
+_copy_executor = None
+
+
+def get_copy_executor() -> ThreadPoolExecutor:
+    """
+    Gets the thread pool used for file copies. It is created on first use and shared by all subsequent copies, so
+    the worker threads are only started once per process.
+
+    :return: The shared thread pool.
+    :rtype: ThreadPoolExecutor
+    """
+    global _copy_executor
+    if _copy_executor is None:
+        _copy_executor = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2))
+        atexit.register(_copy_executor.shutdown, wait=False)
+    return _copy_executor
+
+
+def concatenate_files(files: list, destination_file: str):
+    """
+    Writes the content of the files, one after the other, into a single destination file. On Linux the data is copied
+    inside the kernel with os.sendfile, elsewhere it is streamed through shutil.copyfileobj.
+
+    :param files: The list of files to be concatenated, in order.
+    :type files: list
+    :param destination_file: The path of the combined file.
+    :type destination_file: str
+    """
+    with open(destination_file, 'wb') as destination:
+        for file in files:
+            with open(file, 'rb') as source:
+                if sys.platform.startswith('linux'):
+                    # The destination offset advances with every call, the source is read from its start
+                    offset = 0
+                    remaining = os.fstat(source.fileno()).st_size
+                    while remaining > 0:
+                        sent = os.sendfile(destination.fileno(), source.fileno(), offset, remaining)
+                        if sent == 0:
+                            # The file shrank while it was being copied, never leave a silently truncated output
+                            raise OSError(f"Unexpected end of {file} while concatenating it into {destination_file}")
+                        offset += sent
+                        remaining -= sent
+                else:
+                    shutil.copyfileobj(source, destination)
+    invalidate_directory_cache(destination_file)
+
+
+def copy_files_to_destination(files: list, destination: str, mode: str = 'copy'):
     """
     Copies the files inside the list to the destination directory in a parallel fashion.
 
     :param files: The list of files to be copied.
     :type files: list
-    :param destination: The path to the destination directory.
+    :param destination: The path to the destination directory, or the path of the combined file in 'concat' mode.
     :type destination: str
+    :param mode: 'copy' to copy each file into the destination directory, 'concat' to concatenate the files, in
+                 order, into a single destination file.
+    :type mode: str
+    :raises ValueError: If the mode is not supported.
     """
-    with Pool(processes=len(files)) as pool:
-        pool.starmap(copy_file, [(file, destination) for file in files])
+    if mode == 'concat':
+        concatenate_files(files, destination)
+        return
+    if mode != 'copy':
+        raise ValueError(f"Unsupported copy mode: {mode}")
+
+    # A single file (e.g. one CT per tracer) is copied inline, without handing it to the thread pool
+    if len(files) <= 1:
+        for file in files:
+            copy_file(file, destination)
+        return
+
+    # The copies are I/O bound and release the GIL, so threads are enough and avoid forking a process per file
+    list(get_copy_executor().map(lambda file: copy_file(file, destination), files))
 
 
 def select_files_by_modality(tracer_dirs: list, modality_tag: str) -> list:
@@ -194,14 +358,71 @@ def select_files_by_modality(tracer_dirs: list, modality_tag: str) -> list:
     :rtype: list
     """
     selected_files = []
-    for tracer_dir in tracer_dirs:
-        files = os.listdir(tracer_dir)
-        for file in files:
-            if file.startswith(modality_tag) and file.endswith('.nii') or file.endswith('.nii.gz'):
-                selected_files.append(os.path.join(tracer_dir, file))
+    for entries in scan_directories(tracer_dirs):
+        for name, path in entries:
+            if name.startswith(modality_tag) and name.endswith(('.nii', '.nii.gz')):
+                selected_files.append(path)
     return selected_files
 
 
+# Directory listings (entry names) keyed by absolute directory path, stored with the modification time (ns) of the
+# directory they were read at
+DIRECTORY_CACHE = {}
+# Listings of directories modified more recently than this are not cached, as a change within the same timestamp
+# tick of the file system would go unnoticed
+DIRECTORY_CACHE_MIN_AGE = 2  # in seconds
+
+
+def scan_directory(directory_path: str) -> list:
+    """
+    Lists the entries of a directory. The listing is cached until the modification time of the directory changes, so
+    repeated scans of an unchanged directory only cost a stat.
+
+    :param directory_path: The path to the directory.
+    :type directory_path: str
+    :return: The (name, path) pairs of the directory entries.
+    :rtype: list
+    """
+    cache_key = os.path.abspath(directory_path)
+    modification_time = os.stat(directory_path).st_mtime_ns
+    cached = DIRECTORY_CACHE.get(cache_key)
+    if cached is not None and cached[0] == modification_time:
+        names = cached[1]
+    else:
+        with os.scandir(directory_path) as entries:
+            names = [entry.name for entry in entries]
+        if time.time_ns() - modification_time > DIRECTORY_CACHE_MIN_AGE * 1_000_000_000:
+            DIRECTORY_CACHE[cache_key] = (modification_time, names)
+    # The paths are built from the given directory path, as os.scandir does
+    return [(name, os.path.join(directory_path, name)) for name in names]
+
+
+def invalidate_directory_cache(file_path: str):
+    """
+    Drops the cached listing of the directory containing the file, after the file was created or removed.
+
+    :param file_path: The path to the file.
+    :type file_path: str
+    """
+    DIRECTORY_CACHE.pop(os.path.dirname(os.path.abspath(file_path)), None)
+
+
+def scan_directories(directory_paths: list) -> list:
+    """
+    Lists the entries of several directories, reading the directories concurrently so that their I/O overlaps
+    (e.g. on network file systems or a cold cache).
+
+    :param directory_paths: The paths to the directories.
+    :type directory_paths: list
+    :return: The (name, path) pairs of each directory, in the order of the directories.
+    :rtype: list
+    """
+    if len(directory_paths) <= 1:
+        return [scan_directory(directory_path) for directory_path in directory_paths]
+    with ThreadPoolExecutor(max_workers=min(32, len(directory_paths))) as executor:
+        return list(executor.map(scan_directory, directory_paths))
+
+
 def organise_files_by_modality(tracer_dirs: list, modalities: list, pumaz_dir) -> None:
     """
     Organises the files by modality.
@@ -213,9 +434,39 @@ def organise_files_by_modality(tracer_dirs: list, modalities: list, pumaz_dir) -
     :param pumaz_dir: The path to the pumaz directory.
     :type pumaz_dir: str
     """
-    for modality in modalities:
-        files_to_copy = select_files_by_modality(tracer_dirs, modality)
-        copy_files_to_destination(files_to_copy, os.path.join(pumaz_dir, modality))
+    files_by_modality = group_files_by_modality(tracer_dirs, modalities)
+    if len(modalities) <= 1:
+        for modality in modalities:
+            copy_files_to_destination(files_by_modality[modality], os.path.join(pumaz_dir, modality))
+        return
+
+    # The modalities are copied concurrently. This pool only waits on the shared copy pool, so the two cannot deadlock
+    with ThreadPoolExecutor(max_workers=min(len(modalities), os.cpu_count() or 1)) as executor:
+        list(executor.map(lambda modality: copy_files_to_destination(files_by_modality[modality],
+                                                                     os.path.join(pumaz_dir, modality)), modalities))
+
+
+def group_files_by_modality(tracer_dirs: list, modalities: list) -> dict:
+    """
+    Groups the files of the tracer directories by modality tag, reading each tracer directory only once.
+
+    :param tracer_dirs: The list of tracer directories.
+    :type tracer_dirs: list
+    :param modalities: The list of modality tags.
+    :type modalities: list
+    :return: A dictionary mapping each modality tag to its list of files.
+    :rtype: dict
+    """
+    files_by_modality = {modality: [] for modality in modalities}
+    for entries in scan_directories(tracer_dirs):
+        for name, path in entries:
+            if not name.endswith(('.nii', '.nii.gz')):
+                continue
+            # A file is listed under every modality tag it starts with, as select_files_by_modality does
+            for modality, files in files_by_modality.items():
+                if name.startswith(modality):
+                    files.append(path)
+    return files_by_modality
 
 
 def move_file(file, destination):
@@ -227,10 +478,51 @@ def move_file(file, destination):
     :param destination: The path to the destination directory.
     :type destination: str
     """
-    shutil.move(file, destination)
+    target = os.path.join(destination, os.path.basename(file)) if os.path.isdir(destination) else destination
+    if os.path.exists(target):
+        # os.replace would silently overwrite it, shutil refuses to move a file onto an existing one in a directory
+        shutil.move(file, destination)
+    else:
+        try:
+            # A single rename if both paths are on the same file system
+            os.replace(file, target)
+        except OSError:
+            # e.g. across file systems, shutil copies the file and removes the source
+            shutil.move(file, target)
+    invalidate_directory_cache(file)
+    invalidate_directory_cache(target)
+
+
+@functools.lru_cache(maxsize=1)
+def get_total_threads() -> int:
+    """
+    Gets the number of logical CPUs, which does not change during the lifetime of the process.
 
+    :return: The number of logical CPUs.
+    :rtype: int
+    """
+    return psutil.cpu_count() or 1
 
-def get_number_of_possible_jobs(process_memory: int, process_threads: int) -> int:
+
+MEMORY_SAMPLING_INTERVAL = 1.0  # in seconds
+_memory_sample = {'time': None, 'available': 0}
+
+
+def get_available_memory() -> int:
+    """
+    Gets the available system memory, sampled at most once per MEMORY_SAMPLING_INTERVAL.
+
+    :return: The available memory in bytes.
+    :rtype: int
+    """
+    now = time.monotonic()
+    if _memory_sample['time'] is None or now - _memory_sample['time'] > MEMORY_SAMPLING_INTERVAL:
+        _memory_sample['available'] = psutil.virtual_memory().available
+        _memory_sample['time'] = now
+    return _memory_sample['available']
+
+
+def get_number_of_possible_jobs(process_memory: int, process_threads: int) -> tuple:
     """
     Gets the number of available jobs based on system specifications and process parameters.
 
@@ -238,21 +530,21 @@ def get_number_of_possible_jobs(process_memory: int, process_threads: int) -> in
     :type process_memory: int
     :param process_threads: Specify how many threads a process needs.
     :type process_threads: int
-    :return: Number of possible concurrent jobs as integer number.
-    :rtype: int
+    :return: Number of possible concurrent jobs, available memory in GB and available threads.
+    :rtype: tuple
     """
 
-    # Calculates minimum memory and thread number for process
-    min_memory = process_memory * 1024 * 1024 * 1024  # GB
+    # Calculates minimum memory (in bytes) and thread number for process
+    min_memory = process_memory * 1024 * 1024 * 1024
     min_threads = process_threads
 
-    # Get currently available resources
-    available_memory = psutil.virtual_memory().available
-    available_memory = round(available_memory / 1024 / 1024 / 1024)
-    available_threads = psutil.cpu_count()
+    # Get currently available resources, the memory is kept in bytes to match the minimum memory
+    available_memory_bytes = get_available_memory()
+    available_memory = round(available_memory_bytes / 1024 / 1024 / 1024)  # GB, for display
+    available_threads = get_total_threads()
 
     # Calculate number (integer) of possible jobs based on memory and thread number
-    possible_jobs_memory = available_memory // min_memory
+    possible_jobs_memory = available_memory_bytes // min_memory
     possible_jobs_threads = available_threads // min_threads
 
     # Get the smallest value to determine number of jobs
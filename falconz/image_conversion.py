@@ -17,18 +17,21 @@ Usage:
 import logging
 import os
 import pathlib
-import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List
 
-import dask
 import nibabel as nib
+import numpy as np
 import pydicom
-from dask import delayed
 from falconz.constants import C3D_PATH, VALID_EXTENSIONS, DCM2NIIX_PATH
 
 from falconz import file_utilities as fop
 
+# A DICOM file starts with a 128 byte preamble followed by the magic bytes
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_MAGIC = b'DICM'
+
 
 class NiftiConverter:
     """
@@ -49,7 +52,8 @@ class NiftiConverter:
         """
         if not os.path.exists(input_directory):
             raise NiftiConverterError(f"Input directory '{input_directory}' does not exist or is not accessible.")
-        self.VALID_EXTENSIONS = VALID_EXTENSIONS
+        # Kept as a tuple, so that a single str.endswith call checks all extensions
+        self.VALID_EXTENSIONS = tuple(VALID_EXTENSIONS)
         self.input_directory = input_directory
         self.output_directory = output_directory if output_directory else os.path.join(input_directory, 'converted')
         self._ensure_output_directory_exists()
@@ -66,12 +70,16 @@ class NiftiConverter:
     def _process_input_directory(self):
         """Processes the input directory based on the image types present."""
         try:
-            file_list = [f for f in os.listdir(self.input_directory) if
-                         os.path.isfile(os.path.join(self.input_directory, f))]
+            # scandir carries the file type of each entry, so no extra stat is needed per file. The list is sorted, as
+            # the directory order depends on the file system.
+            with os.scandir(self.input_directory) as entries:
+                file_list = sorted(entry.name for entry in entries if entry.is_file())
         except Exception as e:
             raise NiftiConverterError(f"Error processing input directory: {e}")
 
-        if self._contains_dicom_images(file_list):
+        # Input that is NIFTI only cannot be a DICOM series, so the DICOM probe is skipped
+        nifti_only = len(file_list) > 0 and all(file.endswith(('.nii', '.nii.gz')) for file in file_list)
+        if not nifti_only and self._contains_dicom_images(file_list):
             self._convert_dicom_series()
         elif len(file_list) == 1:
             self._process_single_image_file(file_list[0])
@@ -86,25 +94,58 @@ class NiftiConverter:
         :return: True if DICOM images are detected, False otherwise.
         :rtype: bool
         """
-        return any(self._is_dicom(os.path.join(self.input_directory, file)) for file in file_list)
+        file_paths = [os.path.join(self.input_directory, file) for file in file_list]
+        if len(file_paths) <= 1:
+            return any(self._is_dicom(file_path) for file_path in file_paths)
+
+        # The files are probed concurrently, as the reads are I/O bound. The pending probes are cancelled as soon as one
+        # DICOM file is found.
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            contains_dicom = any(executor.map(self._is_dicom, file_paths))
+            executor.shutdown(cancel_futures=True)
+        return contains_dicom
+
+    @staticmethod
+    def _has_dicom_magic(file_path):
+        """
+        Checks if a file carries the DICOM magic bytes ('DICM' after the 128 byte preamble). Only 132 bytes are read.
+
+        :param str file_path: Path to the file.
+        :return: True if the magic bytes are present, False otherwise.
+        :rtype: bool
+        """
+        try:
+            with open(file_path, 'rb') as file:
+                file.seek(DICOM_PREAMBLE_LENGTH)
+                return file.read(len(DICOM_MAGIC)) == DICOM_MAGIC
+        except OSError:
+            return False
 
     def _convert_dicom_series(self):
         """Converts DICOM series in the directory to 3D NIFTI files."""
         self.dcm2niix(self.input_directory, self.output_directory)
-        # remove the json file
-        json_file = [f for f in os.listdir(self.output_directory) if f.endswith('.json')]
-        if len(json_file) > 0:
-            os.remove(os.path.join(self.output_directory, json_file[0]))
 
-        # Scan the output directory for the generated nifti files
-        converted_files = [f for f in os.listdir(self.output_directory) if (f.endswith('.nii.gz') or f.endswith('.nii'))]
+        # Scan the output directory once for the json sidecar and the generated nifti files
+        json_files = []
+        converted_files = []
+        with os.scandir(self.output_directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith('.json'):
+                    json_files.append(entry.path)
+                elif entry.name.endswith(('.nii.gz', '.nii')):
+                    converted_files.append(entry.path)
 
-        for nifti_file in converted_files:
-            file_path = os.path.join(self.output_directory, nifti_file)
+        # remove the json file
+        if len(json_files) > 0:
+            os.remove(json_files[0])
 
+        for file_path in converted_files:
             # Check if the file is 4D and needs to be split
-            if self._is_4d_image(file_path):
-                self._split_4d_image(file_path)
+            image = self._load_4d_image(file_path)
+            if image is not None:
+                self._split_4d_image(file_path, image)
                 os.remove(file_path)
 
     def _process_single_image_file(self, file_name):
@@ -117,23 +158,30 @@ class NiftiConverter:
         if not self._has_valid_extension(file_name):
             raise NiftiConverterError(f"Unsupported file format: {file_name}")
 
-        if self._is_4d_image(full_path):
-            self._split_4d_image(full_path)
+        image = self._load_4d_image(full_path)
+        if image is not None:
+            self._split_4d_image(full_path, image)
         else:
             raise NiftiConverterError("Only a single 3D volume provided. Expecting a 4D volume or multiple 3D volumes.")
 
     def _process_multiple_image_files(self, file_list):
-        tasks = []  # List to hold delayed tasks
+        images_to_convert = []  # List to hold the images that need a c3d conversion
         for file_name in file_list:
             full_path = os.path.join(self.input_directory, file_name)
             if file_name.endswith(('.nii', '.nii.gz')):
-                shutil.copy(full_path, self.output_directory)
+                # NIFTI files are only read downstream, a hard link avoids copying them where possible
+                fop.link_or_copy_file(full_path, os.path.join(self.output_directory, file_name))
             elif self._has_valid_extension(file_name):
-                # Add the task to the list
-                tasks.append(self._convert_to_nifti_format(full_path))
+                images_to_convert.append(full_path)
 
-        # Compute the tasks in parallel
-        dask.compute(*tasks)
+        if not images_to_convert:
+            return
+        # Each conversion is a c3d child process, so threads are enough to run them in parallel. The pool bounds the
+        # number of concurrent conversions, and the first failure is raised once it completes.
+        with ThreadPoolExecutor(max_workers=min(len(images_to_convert), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(self._convert_to_nifti_format, image_path) for image_path in images_to_convert]
+            for future in as_completed(futures):
+                future.result()
 
     def _has_valid_extension(self, file_name):
         """
@@ -143,7 +191,7 @@ class NiftiConverter:
         :return: True if valid, False otherwise.
         :rtype: bool
         """
-        return any(file_name.endswith(ext) for ext in self.VALID_EXTENSIONS)
+        return file_name.endswith(self.VALID_EXTENSIONS)
 
     def _is_4d_image(self, image_path):
         """
@@ -153,11 +201,26 @@ class NiftiConverter:
         :return: True if the image is 4D, False otherwise.
         :rtype: bool
         """
+        return self._load_4d_image(image_path) is not None
+
+    def _load_4d_image(self, image_path):
+        """
+        Loads an image if it is 4D. Only the header is read, the voxel data stays behind the image proxy, so the
+        returned image can be handed to _split_4d_image without opening the file again.
+
+        :param str image_path: Path to the image file.
+        :return: The loaded image if it is 4D, None otherwise.
+        :rtype: nibabel.spatialimages.SpatialImage
+        """
         try:
-            img = nib.funcs.squeeze_image(nib.load(image_path))
-            return img.ndim == 4
-        except:
-            return False
+            image = nib.load(image_path)
+            # Trailing singleton dimensions are ignored, as nib.funcs.squeeze_image does
+            shape = list(image.header.get_data_shape())
+            while len(shape) > 3 and shape[-1] == 1:
+                shape.pop()
+            return image if len(shape) == 4 else None
+        except Exception:
+            return None
 
     def _is_dicom(self, file_path):
         """
@@ -167,35 +230,56 @@ class NiftiConverter:
         :return: True if the file is a DICOM image, False otherwise.
         :rtype: bool
         """
+        # Files without the magic bytes are rejected with a 132 byte read, without raising inside pydicom
+        if not self._has_dicom_magic(file_path):
+            return False
         try:
-            _ = pydicom.dcmread(file_path)
+            # Only the metadata is parsed, the pixel data and other large elements are never read
+            pydicom.dcmread(file_path, stop_before_pixels=True, defer_size='1 KB', force=False)
             return True
-        except:
+        except Exception:
             return False
 
-    def _split_4d_image(self, image_path):
+    def _split_4d_image(self, image_path, image=None):
         """
         Splits a 4D image into multiple 3D NIFTI volumes.
 
         :param str image_path: Path to the 4D image file.
+        :param nibabel.spatialimages.SpatialImage image: The already loaded 4D image, if available.
         """
         try:
-            split_nifti_files = nib.funcs.four_to_three(nib.funcs.squeeze_image(nib.load(image_path)))
-            for i, file in enumerate(split_nifti_files):
+            if image is None:
+                image = nib.load(image_path)
+            image = nib.funcs.squeeze_image(image)
+            if image.ndim != 4:
+                raise ValueError('Expecting four dimensions')
+            # Uncompressed images are read one frame at a time through the image proxy, so the 4D data is never held in
+            # memory as a whole. A gzip stream cannot be sliced without decompressing it from the start, so compressed
+            # images are decompressed once and the frames are views into that array.
+            if image_path.endswith('.gz'):
+                image_data = np.asanyarray(image.dataobj)
+            else:
+                image_data = image.dataobj
+
+            def save_frame(index):
                 # file name should start with vol, with 4 digits, using leading zeros (zfill)
-                file_name = 'vol_' + str(i).zfill(4) + '.nii.gz'
-                output_path = os.path.join(self.output_directory, file_name)
-                nib.save(file, output_path)
+                output_path = os.path.join(self.output_directory, 'vol_' + str(index).zfill(4) + '.nii.gz')
+                frame = np.asanyarray(image_data[..., index])
+                nib.save(image.__class__(frame, image.affine, image.header), output_path)
+
+            number_of_frames = image.shape[3]
+            # The volumes are saved concurrently, zlib releases the GIL while it compresses
+            with ThreadPoolExecutor(max_workers=min(number_of_frames, os.cpu_count() or 1)) as executor:
+                list(executor.map(save_frame, range(number_of_frames)))
         except Exception as e:
             raise NiftiConverterError(f"Error splitting 4D image: {e}")
 
-    @delayed
     def _convert_to_nifti_format(self, image_path):
         try:
             output_path = os.path.join(self.output_directory, f"{pathlib.Path(image_path).stem}.nii.gz")
-            cmd_to_run = f"{C3D_PATH} {image_path} -o {output_path}"
-            cmd_to_run = cmd_to_run.replace("\n", " ").strip()
-            subprocess.run(cmd_to_run, shell=True, check=True)
+            # An argv list runs c3d directly, without an intermediate shell, and keeps paths with spaces intact
+            cmd_to_run: List[str] = [C3D_PATH, image_path, '-o', output_path]
+            subprocess.run(cmd_to_run, check=True)
         except Exception as e:
             raise NiftiConverterError(f"Error converting image to NIFTI: {e}")
 
@@ -237,6 +321,18 @@ def merge3d(nifti_dir: str, wild_card: str, nifti_outfile: str) -> None:
     logging.info(f"Merging 3D nifti files in {nifti_dir} with wildcard {wild_card}")
     files_to_merge = fop.get_files(nifti_dir, wild_card)
     numeric_sorted_files_to_merge = sorted(files_to_merge, key=fop.numeric_sort_key)
-    nib.save(nib.funcs.concat_images(numeric_sorted_files_to_merge, False), nifti_outfile)
+    # Stream the frames into a preallocated 4D array, so only one frame is decoded in memory at a time. The array is in
+    # Fortran order, the on-disk NIFTI layout, which makes every frame a contiguous block and the write a plain dump.
+    # The array keeps the data type of the first frame: its on-disk type (get_data_dtype()), or the floating point
+    # type its values are scaled to if the frame has a scl_slope/scl_inter.
+    first_frame = nib.load(numeric_sorted_files_to_merge[0])
+    first_frame_data = np.asanyarray(first_frame.dataobj)
+    merged_data = np.empty(first_frame.shape + (len(numeric_sorted_files_to_merge),),
+                           dtype=np.promote_types(first_frame.get_data_dtype(), first_frame_data.dtype), order='F')
+    merged_data[..., 0] = first_frame_data
+    del first_frame_data
+    for index, frame_file in enumerate(numeric_sorted_files_to_merge[1:], start=1):
+        merged_data[..., index] = np.asanyarray(nib.load(frame_file).dataobj)
+    nib.save(nib.Nifti1Image(merged_data, first_frame.affine, first_frame.header), nifti_outfile)
     os.chdir(nifti_dir)
     logging.info("Done")
@@ -14,16 +14,19 @@ Usage:
     The functions in this module can be imported and used in other modules within the falconz to perform image conversion.
 """
 
+import gzip
 import logging
 import multiprocessing
 import os
-import pathlib
+import shutil
 import subprocess
+import tempfile
 
 import SimpleITK as sitk
+import nibabel as nib
+import numpy as np
 import pandas as pd
-from dask import delayed
-from dask.distributed import Client, as_completed
+from scipy import ndimage
 from falconz.constants import GREEDY_PATH, C3D_PATH, NCC_RADIUS, NCC_THRESHOLD, COST_FUNCTION, PROPORTION_OF_CORES
 from falconz.resources import get_system_stats
 from mpire import WorkerPool
@@ -32,6 +35,14 @@ from rich.progress import Progress, BarColumn, TimeElapsedColumn
 from falconz import constants
 from falconz import file_utilities as fop
 
+SHARED_MEMORY_DIR = '/dev/shm'
+# Free space required in the shared memory folder, relative to the size of the staged image (e.g. Docker only gives
+# /dev/shm 64 MB by default)
+SHARED_MEMORY_HEADROOM = 2
+STAGING_CHUNK_SIZE = 1024 * 1024
+# Peak number of image sized arrays calc_mean_ncc holds besides the shared reference moments
+NCC_ARRAYS_PER_JOB = 6
+
 
 class ImageRegistration:
     """
@@ -45,13 +56,15 @@ class ImageRegistration:
         String specifying the number of iterations at each resolution level.
     fixed_mask : str, optional
         Path to a mask for the fixed image. If provided, only the masked region of the fixed image will be used in the registration.
+    threads : int, optional
+        Number of threads greedy may use. If not provided, greedy uses all available cores.
     moving_img : str, optional
         Path to the moving/source image to be registered to the fixed image.
     transform_files : dict, optional
         Dictionary containing paths to the output transformation files for each registration type.
     """
 
-    def __init__(self, fixed_img: str, multi_resolution_iterations: str, fixed_mask: str = None):
+    def __init__(self, fixed_img: str, multi_resolution_iterations: str, fixed_mask: str = None, threads: int = None):
         """
         Initializes the ImageRegistration class.
 
@@ -63,11 +76,17 @@ class ImageRegistration:
             String specifying the number of iterations at each resolution level.
         fixed_mask : str, optional
             Path to the mask of the fixed image.
+        threads : int, optional
+            Number of threads greedy may use.
         """
         self.fixed_img = fixed_img
+        self.fixed_img_name = os.path.basename(fixed_img)
         self.fixed_mask = fixed_mask
+        self.threads = threads
+        self.threads_args = ['-threads', str(threads)] if threads else []
         self.multi_resolution_iterations = multi_resolution_iterations
         self.moving_img = None
+        self.moving_img_name = None
         self.transform_files = None
 
     def set_moving_image(self, moving_img: str, update_transforms: bool = True):
@@ -81,14 +100,15 @@ class ImageRegistration:
         """
 
         self.moving_img = moving_img
+        self.moving_img_name = os.path.basename(moving_img)
         if update_transforms:
-            out_dir = pathlib.Path(self.moving_img).parent
-            moving_img_filename = pathlib.Path(self.moving_img).name
+            # The transform files are written next to the moving image, prefixed with its file name
+            transform_prefix = os.path.join(os.path.dirname(moving_img), self.moving_img_name)
             self.transform_files = {
-                'rigid': os.path.join(out_dir, f"{moving_img_filename}_rigid.mat"),
-                'affine': os.path.join(out_dir, f"{moving_img_filename}_affine.mat"),
-                'warp': os.path.join(out_dir, f"{moving_img_filename}_warp.nii.gz"),
-                'inverse_warp': os.path.join(out_dir, f"{moving_img_filename}_inverse_warp.nii.gz")
+                'rigid': f"{transform_prefix}_rigid.mat",
+                'affine': f"{transform_prefix}_affine.mat",
+                'warp': f"{transform_prefix}_warp.nii.gz",
+                'inverse_warp': f"{transform_prefix}_inverse_warp.nii.gz"
             }
 
     def rigid(self) -> str:
@@ -100,14 +120,13 @@ class ImageRegistration:
         str
             Path to the resulting rigid transformation file.
         """
-        mask_cmd = f"-gm {self.fixed_mask}" if self.fixed_mask else ""
-        cmd_to_run = f"{GREEDY_PATH} -d 3 -a -i {self.fixed_img} {self.moving_img} " \
-                     f"{mask_cmd} -ia-image-centers -dof 6 -o {self.transform_files['rigid']} " \
-                     f"-n {self.multi_resolution_iterations} -m {COST_FUNCTION}"
-        subprocess.run(cmd_to_run, shell=True, capture_output=True)
-        logging.info(
-            f"Rigid alignment: {pathlib.Path(self.moving_img).name} -> {pathlib.Path(self.fixed_img).name} | Aligned image: "
-            f"moco-{pathlib.Path(self.moving_img).name} | Transform file: {pathlib.Path(self.transform_files['rigid']).name}")
+        cmd_to_run = [GREEDY_PATH, '-d', '3', '-a', '-i', self.fixed_img, self.moving_img, *self._mask_args(),
+                      '-ia-image-centers', '-dof', '6', '-o', self.transform_files['rigid'],
+                      '-n', self.multi_resolution_iterations, '-m', *COST_FUNCTION.split(), *self.threads_args]
+        subprocess.run(cmd_to_run, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # The message is only formatted if INFO records are logged
+        logging.info("Rigid alignment: %s -> %s | Aligned image: moco-%s | Transform file: %s", self.moving_img_name,
+                     self.fixed_img_name, self.moving_img_name, os.path.basename(self.transform_files['rigid']))
         return self.transform_files['rigid']
 
     def affine(self) -> str:
@@ -119,14 +138,12 @@ class ImageRegistration:
         str
             Path to the resulting affine transformation file.
         """
-        mask_cmd = f"-gm {self.fixed_mask}" if self.fixed_mask else ""
-        cmd_to_run = f"{GREEDY_PATH} -d 3 -a -i {self.fixed_img} {self.moving_img} " \
-                     f"{mask_cmd} -ia-image-centers -dof 12 -o {self.transform_files['affine']} " \
-                     f"-n {self.multi_resolution_iterations} -m {COST_FUNCTION}"
-        subprocess.run(cmd_to_run, shell=True, capture_output=True)
-        logging.info(
-            f"Affine alignment: {pathlib.Path(self.moving_img).name} -> {pathlib.Path(self.fixed_img).name} |"
-            f" Aligned image: moco-{pathlib.Path(self.moving_img).name} | Transform file: {pathlib.Path(self.transform_files['affine']).name}")
+        cmd_to_run = [GREEDY_PATH, '-d', '3', '-a', '-i', self.fixed_img, self.moving_img, *self._mask_args(),
+                      '-ia-image-centers', '-dof', '12', '-o', self.transform_files['affine'],
+                      '-n', self.multi_resolution_iterations, '-m', *COST_FUNCTION.split(), *self.threads_args]
+        subprocess.run(cmd_to_run, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        logging.info("Affine alignment: %s -> %s | Aligned image: moco-%s | Transform file: %s", self.moving_img_name,
+                     self.fixed_img_name, self.moving_img_name, os.path.basename(self.transform_files['affine']))
         return self.transform_files['affine']
 
     def deformable(self) -> tuple:
@@ -139,16 +156,14 @@ class ImageRegistration:
             A tuple containing paths to the resulting affine, warp, and inverse warp transformation files.
         """
         self.affine()
-        mask_cmd = f"-gm {self.fixed_mask}" if self.fixed_mask else ""
-        cmd_to_run = f"{GREEDY_PATH} -d 3 -m {COST_FUNCTION} -i {self.fixed_img} {self.moving_img} " \
-                     f"{mask_cmd} -it {self.transform_files['affine']} -o {self.transform_files['warp']} " \
-                     f"-oinv {self.transform_files['inverse_warp']} -sv -n {self.multi_resolution_iterations}"
-        subprocess.run(cmd_to_run, shell=True, capture_output=True)
-        logging.info(
-            f"Deformable alignment: {pathlib.Path(self.moving_img).name} -> {pathlib.Path(self.fixed_img).name} | "
-            f"Aligned image: moco-{pathlib.Path(self.moving_img).name} | "
-            f"Initial alignment: {pathlib.Path(self.transform_files['affine']).name}"
-            f" | warp file: {pathlib.Path(self.transform_files['warp']).name}")
+        cmd_to_run = [GREEDY_PATH, '-d', '3', '-m', *COST_FUNCTION.split(), '-i', self.fixed_img, self.moving_img,
+                      *self._mask_args(), '-it', self.transform_files['affine'], '-o', self.transform_files['warp'],
+                      '-oinv', self.transform_files['inverse_warp'], '-sv', '-n', self.multi_resolution_iterations,
+                      *self.threads_args]
+        subprocess.run(cmd_to_run, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        logging.info("Deformable alignment: %s -> %s | Aligned image: moco-%s | Initial alignment: %s | warp file: %s",
+                     self.moving_img_name, self.fixed_img_name, self.moving_img_name,
+                     os.path.basename(self.transform_files['affine']), os.path.basename(self.transform_files['warp']))
         return self.transform_files['affine'], self.transform_files['warp'], self.transform_files['inverse_warp']
 
     def registration(self, registration_type: str) -> None:
@@ -169,6 +184,31 @@ class ImageRegistration:
         else:
             sys.exit("Registration type not supported!")
 
+    def register_and_resample(self, moving_img: str, registration_type: str, moco_dir: str) -> int:
+        """
+        Register a moving image to the fixed image and resample it into the motion corrected directory. The same
+        instance can be reused for all moving images of a fixed image.
+
+        Parameters:
+        -----------
+        moving_img : str
+            Path to the moving/source image.
+        registration_type : str
+            Type of registration to perform. Supported values are 'rigid', 'affine', and 'deformable'.
+        moco_dir : str
+            The directory to store the resampled moving image.
+
+        Returns:
+        --------
+        int
+            1, once the moving image is aligned.
+        """
+        self.set_moving_image(moving_img)
+        self.registration(registration_type)
+        self.resample(resampled_moving_img=os.path.join(moco_dir, constants.MOCO_PREFIX + os.path.basename(moving_img)),
+                      registration_type=registration_type)
+        return 1
+
     def resample(self, resampled_moving_img: str, registration_type: str, segmentation="", resampled_seg="") -> None:
         """
         Resample the moving image based on the computed transformation.
@@ -193,10 +233,21 @@ class ImageRegistration:
         elif registration_type == 'deformable':
             cmd_to_run = self._build_cmd(resampled_moving_img, segmentation, resampled_seg,
                                          self.transform_files['warp'], self.transform_files['affine'])
-        subprocess.run(cmd_to_run, shell=True, capture_output=True)
+        subprocess.run(cmd_to_run, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _mask_args(self) -> list:
+        """
+        Build the greedy arguments for the fixed image mask.
+
+        Returns:
+        --------
+        list
+            The mask arguments, empty if no mask is set.
+        """
+        return ['-gm', self.fixed_mask] if self.fixed_mask else []
 
     def _build_cmd(self, resampled_moving_img: str, segmentation: str, resampled_seg: str,
-                   *transform_files: str) -> str:
+                   *transform_files: str) -> list:
         """
         Build the command for the greedy registration tool.
 
@@ -213,20 +264,20 @@ class ImageRegistration:
 
         Returns:
         --------
-        str
-            The command string to run.
+        list
+            The command to run, as an argument list.
         """
-        cmd = f"{GREEDY_PATH} -d 3 -rf {self.fixed_img} -ri LINEAR -rm " \
-              f"{self.moving_img} {resampled_moving_img}"
+        cmd = [GREEDY_PATH, '-d', '3', '-rf', self.fixed_img, '-ri', 'LINEAR', '-rm', self.moving_img,
+               resampled_moving_img]
         if segmentation and resampled_seg:
-            cmd += f" -ri LABEL 0.2vox -rm {segmentation} {resampled_seg}"
+            cmd += ['-ri', 'LABEL', '0.2vox', '-rm', segmentation, resampled_seg]
         for transform_file in transform_files:
-            cmd += f" -r {transform_file}"
+            cmd += ['-r', transform_file]
+        cmd += self.threads_args
         return cmd
 
 
-@delayed
-def align_single_image(fixed_img, moving_img, registration_type, multi_resolution_iterations, moco_dir):
+def align_single_image(fixed_img, moving_img, registration_type, multi_resolution_iterations, moco_dir, threads=None):
     """
     Aligns a single moving image to the fixed image using the specified registration type.
 
@@ -240,27 +291,117 @@ def align_single_image(fixed_img, moving_img, registration_type, multi_resolutio
     :type multi_resolution_iterations: str
     :param moco_dir: The directory to store the resampled moving image.
     :type moco_dir: str
+    :param threads: The number of threads greedy may use for this image.
+    :type threads: int
     :return: 1
     :rtype: int
     """
-    aligner = ImageRegistration(fixed_img=fixed_img, multi_resolution_iterations=multi_resolution_iterations)
-    aligner.set_moving_image(moving_img)
-    aligner.registration(registration_type)
-    aligner.resample(resampled_moving_img=os.path.join(moco_dir, constants.MOCO_PREFIX + os.path.basename(moving_img)),
-                     registration_type=registration_type)
-    return 1
+    aligner = ImageRegistration(fixed_img=fixed_img, multi_resolution_iterations=multi_resolution_iterations,
+                                threads=threads)
+    return aligner.register_and_resample(moving_img, registration_type, moco_dir)
+
+
+def stage_fixed_image(fixed_img: str, staging_dir: str) -> str:
+    """
+    Puts a byte-identical, uncompressed copy of the fixed image in the staging directory, so that the registrations of
+    all moving images read it without inflating the gzip stream every time. A gzipped image is only inflated, never
+    decoded, so its data type, scaling and orientation are kept as is. An uncompressed image is linked or copied.
+
+    :param fixed_img: The path to the fixed image.
+    :type fixed_img: str
+    :param staging_dir: The directory to write the uncompressed fixed image to.
+    :type staging_dir: str
+    :return: The path to the uncompressed fixed image.
+    :rtype: str
+    """
+    fixed_img_name = os.path.basename(fixed_img)
+    if fixed_img_name.endswith('.nii.gz'):
+        fixed_img_name = fixed_img_name[:-len('.gz')]
+    staged_fixed_img = os.path.join(staging_dir, fixed_img_name)
+    if fixed_img.endswith('.gz'):
+        with gzip.open(fixed_img, 'rb') as compressed_img, open(staged_fixed_img, 'wb') as uncompressed_img:
+            shutil.copyfileobj(compressed_img, uncompressed_img, STAGING_CHUNK_SIZE)
+    else:
+        fop.link_or_copy_file(fixed_img, staged_fixed_img)
+    return staged_fixed_img
+
+
+def get_uncompressed_size(nifti_file: str) -> int:
+    """
+    Gets the size of a NIFTI image once it is written uncompressed. The size of a gzipped image is estimated from its
+    header only.
+
+    :param nifti_file: The path to the NIFTI file.
+    :type nifti_file: str
+    :return: The size of the uncompressed image in bytes.
+    :rtype: int
+    """
+    if not nifti_file.endswith('.gz'):
+        return os.path.getsize(nifti_file)
+    header = nib.load(nifti_file).header
+    return int(np.prod(header.get_data_shape())) * header.get_data_dtype().itemsize
+
+
+def get_staging_root(required_bytes: int):
+    """
+    Gets the folder to stage temporary files in: the memory backed shared memory folder if it exists and has enough
+    free space, the default temporary folder otherwise.
+
+    :param required_bytes: The size of the files to stage in bytes.
+    :type required_bytes: int
+    :return: The folder to stage in, None for the default temporary folder.
+    :rtype: str
+    """
+    if os.path.isdir(SHARED_MEMORY_DIR) and \
+            shutil.disk_usage(SHARED_MEMORY_DIR).free > required_bytes * SHARED_MEMORY_HEADROOM:
+        return SHARED_MEMORY_DIR
+    return None
 
 
 def align(fixed_img, moving_imgs, registration_type, multi_resolution_iterations, moco_dir):
-    # Configuring Dask Client
+    staging_dir = None
+    try:
+        # Keep a single uncompressed copy of the fixed image for all registrations, in memory backed storage if it
+        # fits and in the default temporary folder otherwise. If staging fails, the registrations read the original.
+        try:
+            staging_dir = tempfile.mkdtemp(prefix='falconz-', dir=get_staging_root(get_uncompressed_size(fixed_img)))
+            fixed_img = stage_fixed_image(fixed_img, staging_dir)
+        except (OSError, EOFError) as e:
+            logging.warning("Could not stage an uncompressed copy of %s, using it as is: %s", fixed_img, e)
+
+        align_to_fixed_image(fixed_img, moving_imgs, registration_type, multi_resolution_iterations, moco_dir)
+    finally:
+        if staging_dir is not None:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def align_to_fixed_image(fixed_img, moving_imgs, registration_type, multi_resolution_iterations, moco_dir):
+    """
+    Aligns the moving images to the fixed image in parallel, showing the progress.
+
+    :param fixed_img: The path to the fixed image.
+    :type fixed_img: str
+    :param moving_imgs: The paths to the moving images.
+    :type moving_imgs: list
+    :param registration_type: The type of registration to use.
+    :type registration_type: str
+    :param multi_resolution_iterations: The number of iterations to use for multi-resolution registration.
+    :type multi_resolution_iterations: str
+    :param moco_dir: The directory to store the resampled moving images.
+    :type moco_dir: str
+    """
     num_cores = max(1, int(multiprocessing.cpu_count() * PROPORTION_OF_CORES))
-    client = Client(n_workers=num_cores, threads_per_worker=1)
+    # Split the cores between the concurrent greedy runs, so they do not oversubscribe the machine
+    threads_per_image = max(1, multiprocessing.cpu_count() // num_cores)
 
     total_images = len(moving_imgs)
 
+    # A single aligner holds the fixed image settings, every worker gets its own copy of it
+    aligner = ImageRegistration(fixed_img=fixed_img, multi_resolution_iterations=multi_resolution_iterations,
+                                threads=threads_per_image)
+
     # Define tasks outside of the progress context so that the progress bar appears first
-    tasks = [align_single_image(fixed_img, moving_img, registration_type, multi_resolution_iterations, moco_dir)
-             for moving_img in moving_imgs]
+    tasks = [(moving_img, registration_type, moco_dir) for moving_img in moving_imgs]
 
     with Progress(
             "[progress.description]{task.description}",
@@ -278,17 +419,29 @@ def align(fixed_img, moving_imgs, registration_type, multi_resolution_iterations
         task_id = progress.add_task(task_description, total=total_images,
                                     cpu=cpu_percent, memory=memory_percent)  # Add them to the task fields
 
-        futures = client.compute(tasks)
+        # using mpire to run the registrations in parallel, the tasks are independent greedy runs
+        with WorkerPool(num_cores) as pool:
+            # Update progress bar as tasks complete
+            for _ in pool.imap_unordered(aligner.register_and_resample, tasks):
+                cpu_percent, memory_percent = get_system_stats()  # Get updated stats
+                progress.update(task_id, advance=1,
+                                description="[cyan] Aligned moving images:",
+                                cpu=cpu_percent, memory=memory_percent)  # Update the task with the new stats
 
-        # Update progress bar as tasks complete
-        for future, result in as_completed(futures, with_results=True):
-            cpu_percent, memory_percent = get_system_stats()  # Get updated stats
-            progress.update(task_id, advance=1,
-                            description="[cyan] Aligned moving images:",
-                            cpu=cpu_percent, memory=memory_percent)  # Update the task with the new stats
 
-    # Close the client to release resources after computation
-    client.close()
+def read_image_information(image_file: str) -> sitk.ImageFileReader:
+    """
+    Reads only the header of an image, the voxel data is not decoded.
+
+    :param image_file: The path to the image file.
+    :type image_file: str
+    :return: The reader holding the image information (dimension, pixel type, size, spacing, ...).
+    :rtype: sitk.ImageFileReader
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(image_file)
+    reader.ReadImageInformation()
+    return reader
 
 
 def get_dimensions(nifti_file: str) -> int:
@@ -300,9 +453,7 @@ def get_dimensions(nifti_file: str) -> int:
     :return: The dimensions of the image.
     :rtype: int
     """
-    nifti_img = sitk.ReadImage(nifti_file)
-    img_dim = nifti_img.GetDimension()
-    return img_dim
+    return read_image_information(nifti_file).GetDimension()
 
 
 def get_pixel_id_type(nifti_file: str) -> str:
@@ -314,9 +465,7 @@ def get_pixel_id_type(nifti_file: str) -> str:
     :return: The pixel ID type of the image.
     :rtype: str
     """
-    nifti_img = sitk.ReadImage(nifti_file)
-    pixel_id_type = nifti_img.GetPixelIDTypeAsString()
-    return pixel_id_type
+    return sitk.GetPixelIDValueAsString(read_image_information(nifti_file).GetPixelID())
 
 
 def get_intensity_statistics(nifti_file: str, multi_label_file: str) -> object:
@@ -342,7 +491,23 @@ def get_intensity_statistics(nifti_file: str, multi_label_file: str) -> object:
     return stats_df
 
 
-def downscale_image(downscale_param: tuple, input_image: str) -> str:
+def thread_limited_env(threads: int) -> dict:
+    """
+    Builds an environment for ITK based binaries (c3d, greedy) that caps their number of threads, so that several
+    concurrent processes do not each spawn a thread per core.
+
+    :param threads: The maximum number of threads per process.
+    :type threads: int
+    :return: A copy of the current environment with the thread limits set.
+    :rtype: dict
+    """
+    env = os.environ.copy()
+    env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(threads)
+    env['OMP_NUM_THREADS'] = str(threads)
+    return env
+
+
+def downscale_image(downscale_param: tuple, input_image: str, threads: int = None) -> str:
     """
     Downscale an image based on the shrink factor and save it to the output directory.
     
@@ -350,92 +515,162 @@ def downscale_image(downscale_param: tuple, input_image: str) -> str:
     :type downscale_param: tuple
     :param input_image: The path to the input image.
     :type input_image: str
+    :param threads: The maximum number of threads c3d may use. If not provided, c3d uses all available cores.
+    :type threads: int
     :return: The path to the downscaled image.
     :rtype: str
     """
     output_dir, shrink_factor = downscale_param
     input_image_name = os.path.basename(input_image)
-    # Blur the input image first
-    input_image_blurred = os.path.join(output_dir, f"{shrink_factor}x_blurred_{input_image_name}")
+    input_image_downscaled = os.path.join(output_dir, f"{shrink_factor}x_downscaled_{input_image_name}")
     gauss_variance = (shrink_factor / 2) ** 2
     gauss_variance = int(gauss_variance)
-    cmd_to_smooth = f"{C3D_PATH} {input_image} -smooth-fast {gauss_variance}x{gauss_variance}x{gauss_variance}vox -o" \
-                    f" {input_image_blurred} "
-    subprocess.run(cmd_to_smooth, shell=True, capture_output=False)
-    # Resample the smoothed input image later
-    input_image_downscaled = os.path.join(output_dir, f"{shrink_factor}x_downscaled_{input_image_name}")
     shrink_percentage = str(int(100 / shrink_factor))
-    cmd_to_downscale = f"{C3D_PATH} {input_image_blurred} -resample {shrink_percentage}x{shrink_percentage}x" \
-                       f"{shrink_percentage}% -o {input_image_downscaled}"
-    subprocess.run(cmd_to_downscale, shell=True, capture_output=False)
+    # Blur the input image first and resample the smoothed image, chained in a single c3d run so the blurred image
+    # stays in memory
+    cmd_to_downscale = [C3D_PATH, input_image, '-smooth-fast', f"{gauss_variance}x{gauss_variance}x{gauss_variance}vox",
+                        '-resample', f"{shrink_percentage}x{shrink_percentage}x{shrink_percentage}%",
+                        '-o', input_image_downscaled]
+    env = thread_limited_env(threads) if threads else None
+    subprocess.run(cmd_to_downscale, capture_output=False, env=env)
     return input_image_downscaled
 
 
-# Calculate the mean intensity of an image using SimpleITK
-def calc_mean_intensity(image: str) -> float:
+def get_ncc_window_size(radius: str = NCC_RADIUS) -> tuple:
     """
-    Calculates the mean intensity of an image using SimpleITK
-    :param image: path to the image
-    :return: mean intensity of the image
-    :rtype: float
+    Converts a c3d style NCC radius (e.g. '4x4x4', in x, y, z order) to the window size along the axes of the image
+    arrays returned by load_image_array (also x, y, z order).
+
+    :param radius: The radius of the NCC window in voxels.
+    :type radius: str
+    :return: The window size along each array axis.
+    :rtype: tuple
     """
-    image = sitk.ReadImage(image, sitk.sitkFloat32)
-    return sitk.GetArrayFromImage(image).mean()
+    return tuple(2 * int(axis_radius) + 1 for axis_radius in radius.split('x'))
 
 
-def calc_voxelwise_ncc_images(image1: str, image2: str, output_dir: str) -> str:
+def load_image_array(image: str) -> np.ndarray:
     """
-    Calculates voxelwise normalized cross correlation between two images and writes it to the output directory.
-    
-    :param image1: The path to the first image.
-    :type image1: str
-    :param image2: The path to the second image.
-    :type image2: str
-    :param output_dir: The path to the output directory.
-    :type output_dir: str
-    :return: The path to the voxelwise ncc image.
-    :rtype: str
+    Loads the voxels of a NIFTI image as a float64 array (x, y, z order), the precision needed to compute local
+    variances. nibabel decodes the voxels straight into the float64 array, without an intermediate ITK image.
+
+    :param image: The path to the image.
+    :type image: str
+    :return: The image voxels.
+    :rtype: np.ndarray
+    """
+    return nib.load(image).get_fdata(dtype=np.float64)
+
+
+def calc_local_moments(image_array: np.ndarray, window_size: tuple) -> tuple:
     """
-    # get the image names without the extension '.nii.gz'
-    image1_name = os.path.basename(image1).split(".")[0]
-    image2_name = os.path.basename(image2).split(".")[0]
-    output_image = os.path.join(output_dir, f"ncc_{image2_name}.nii.gz")
-    c3d_cmd = f"{C3D_PATH} {image1} {image2} -ncc {NCC_RADIUS} -o {output_image}"
-    subprocess.run(c3d_cmd, shell=True, capture_output=False)
-    # clip the negative correlations to zero
-    c3d_cmd = f"{C3D_PATH} {output_image} -clip 0 inf -o {output_image}"
-    subprocess.run(c3d_cmd, shell=True, capture_output=False)
-    return output_image
+    Calculates the local mean and variance of an image in a box window.
+
+    :param image_array: The image voxels.
+    :type image_array: np.ndarray
+    :param window_size: The window size along each array axis.
+    :type window_size: tuple
+    :return: The local mean and the local variance.
+    :rtype: tuple
+    """
+    local_mean = ndimage.uniform_filter(image_array, window_size, mode='constant')
+    local_variance = ndimage.uniform_filter(image_array * image_array, window_size, mode='constant')
+    local_variance -= local_mean * local_mean
+    return local_mean, local_variance
+
+
+def calc_reference_moments(reference_image: str, radius: str = NCC_RADIUS) -> tuple:
+    """
+    Loads the reference image and calculates its local moments once, so that they can be reused for every candidate
+    frame by calc_mean_ncc.
+
+    :param reference_image: The path to the reference image.
+    :type reference_image: str
+    :param radius: The radius of the NCC window in voxels (c3d style, e.g. '4x4x4').
+    :type radius: str
+    :return: The reference voxels, their local mean and local variance, and the window size.
+    :rtype: tuple
+    """
+    window_size = get_ncc_window_size(radius)
+    reference_array = load_image_array(reference_image)
+    return (reference_array, *calc_local_moments(reference_array, window_size), window_size)
 
 
-def determine_candidate_frames(candidate_files: list, reference_file: str, output_dir: str, njobs: int) -> int:
+def calc_mean_ncc(reference_moments: tuple, moving_image: str) -> float:
+    """
+    Calculates the mean of the voxelwise normalized cross correlation between the reference and a moving image, with
+    negative correlations clipped to zero. The local sums are computed with box filters, the voxelwise NCC volume is
+    only held in memory and never written to disk.
+
+    :param reference_moments: The reference voxels and local moments, as returned by calc_reference_moments.
+    :type reference_moments: tuple
+    :param moving_image: The path to the moving image.
+    :type moving_image: str
+    :return: The mean voxelwise NCC.
+    :rtype: float
+    """
+    reference_array, reference_mean, reference_variance, window_size = reference_moments
+    moving_array = load_image_array(moving_image)
+    if moving_array.shape != reference_array.shape:
+        raise ValueError(f"{moving_image} does not have the dimensions of the reference image")
+    moving_mean, moving_variance = calc_local_moments(moving_array, window_size)
+
+    # ncc = (E[xy] - E[x]E[y]) / sqrt(Var[x] Var[y]), computed in place to limit the number of full size arrays
+    moving_array *= reference_array
+    covariance = ndimage.uniform_filter(moving_array, window_size, mode='constant')
+    del moving_array
+    covariance -= reference_mean * moving_mean
+    del moving_mean
+    moving_variance *= reference_variance
+    # Voxels without local variation (e.g. the background) have no defined correlation and count as zero. The
+    # denominator is positive, so the negative correlations are clipped to zero by skipping the voxels with a negative
+    # covariance in the division, without a separate clipping pass.
+    correlated = moving_variance > np.finfo(np.float64).eps
+    correlated &= covariance > 0
+    ncc = np.divide(covariance, np.sqrt(moving_variance, out=moving_variance), out=np.zeros_like(covariance),
+                    where=correlated)
+    return float(ncc.mean())
+
+
+def determine_candidate_frames(candidate_files: list, reference_file: str, output_dir: str, njobs: int,
+                               shrink_factor: int = None) -> int:
     """
     Determines the candidate frames of a 4D PET series on which motion correction can be performed effectively
     :param candidate_files: list of 3D candidate moving PET files
     :param reference_file: path to the reference PET file
     :param output_dir: path to the parent directory of the candidate files
     :param njobs: number of jobs to run in parallel
+    :param shrink_factor: if provided, the frames are compared on images downscaled by this factor
     :return:  Index of the starting frame from which motion correction can be performed
     :rtype: int
     """
     # Get the parent directory for pet_files
     falcon_dir = output_dir
 
-    # Create the folder to dump the ncc images
-    ncc_dir = os.path.join(falcon_dir, "ncc-images")
-    fop.create_directory(ncc_dir)
-
-    # using mpire to run the ncc calculation in parallel
-    with WorkerPool(njobs) as pool:
-        ncc_images = pool.map(calc_voxelwise_ncc_images, [(reference_file, file, ncc_dir) for file in candidate_files])
-
-    ncc_images = fop.get_files(ncc_dir, "ncc_*.nii.gz")
-    # calculate the mean intensity of files in the ncc folder and store it as mean_intensities
-    mean_intensities = [calc_mean_intensity(ncc_image) for ncc_image in ncc_images]
+    # The start frame is a low frequency decision, so the frames can optionally be compared at a coarser resolution
+    ncc_reference_file, ncc_candidate_files = reference_file, candidate_files
+    if shrink_factor:
+        downscaled_dir = os.path.join(falcon_dir, "downscaled-images")
+        fop.create_directory(downscaled_dir)
+        # The cores are shared between the concurrent c3d processes
+        threads_per_job = max(1, multiprocessing.cpu_count() // njobs)
+        with WorkerPool(njobs) as pool:
+            downscaled_files = pool.map(downscale_image, [((downscaled_dir, shrink_factor), file, threads_per_job)
+                                                          for file in [reference_file] + candidate_files])
+        ncc_reference_file, ncc_candidate_files = downscaled_files[0], downscaled_files[1:]
+
+    # The local moments of the reference are computed once and shared with the workers (copy-on-write)
+    reference_moments = calc_reference_moments(ncc_reference_file)
+    # Every job holds NCC_ARRAYS_PER_JOB full size float64 volumes at its peak, so only run as many as fit in memory
+    memory_per_job = reference_moments[0].nbytes * NCC_ARRAYS_PER_JOB
+    njobs = max(1, min(njobs, fop.get_available_memory() // memory_per_job))
+    # using mpire to calculate the mean ncc of every candidate frame in parallel, in the order of the candidate files
+    with WorkerPool(njobs, shared_objects=reference_moments) as pool:
+        mean_intensities = pool.map(calc_mean_ncc, ncc_candidate_files)
+    mean_intensities = np.asarray(mean_intensities)
     # calculate the average value of the top 3 mean intensities
-    max_observed_ncc = sum(sorted(mean_intensities, reverse=True)[:3]) / 3
-    # Identify the indices of the frames with mean intensity greater than NCC_THRESHOLD * max_observed_ncc
-    candidate_frames = [i for i, mean_intensity in enumerate(mean_intensities) if
-                        mean_intensity > NCC_THRESHOLD * max_observed_ncc]
-    # return the filenames corresponding to the candidate frames
+    max_observed_ncc = np.sort(mean_intensities)[::-1][:3].sum() / 3
+    # Identify the first frame with mean intensity greater than NCC_THRESHOLD * max_observed_ncc
+    candidate_frames = np.flatnonzero(mean_intensities > NCC_THRESHOLD * max_observed_ncc)
+    # return the filename corresponding to the first candidate frame
     return candidate_files[candidate_frames[0]]
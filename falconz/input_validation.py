@@ -16,7 +16,7 @@ Usage:
 import logging
 import os
 
-from falconz.constants import ALLOWED_MODES
+from falconz.constants import ALLOWED_MODES, ALLOWED_REGISTRATION_PARADIGMS
 
 
 class InputValidation:
@@ -68,9 +68,8 @@ class InputValidation:
         """
         Checks if the registration type is valid.
         """
-        allowed_registration_paradigms = ["rigid", "affine", "deformable"]
-        if self.args.registration not in allowed_registration_paradigms:
-            raise ValueError(f"Invalid registration type. Allowed values are: {allowed_registration_paradigms}")
+        if self.args.registration not in ALLOWED_REGISTRATION_PARADIGMS:
+            raise ValueError(f"Invalid registration type. Allowed values are: {ALLOWED_REGISTRATION_PARADIGMS}")
 
     def _check_multi_resolution_iterations(self):
         """
@@ -55,8 +55,8 @@ setup(
         'psutil',
         'nilearn',
         'scikit-image',
-        'dask',
-        'dask[distributed]'
+        'scipy',
+        'zstandard'
     ],
     entry_points={
         'console_scripts': [